@@ -0,0 +1,46 @@
+import argparse
+from datetime import datetime, timedelta
+from tortoise import Tortoise, run_async
+
+from database import TORTOISE_ORM
+from models.order import OrderDB, OrderArchiveDB
+from models.shards import shards
+
+
+async def archive_orders(days: int, batch_size: int = 1000) -> int:
+    """
+    Переносит в архив (OrderArchiveDB) заказы, выполненные больше days дней назад. Рейтинг курьера
+    и список выполненных заказов учитывают архив, заработок хранится у курьера и не пересчитывается
+    :param days: сколько дней выполненный заказ остаётся в основной таблице
+    :param batch_size: сколько заказов переносится за один шаг
+    :return: количество перенесённых заказов
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    for db in shards():
+        while True:
+            orders = await OrderDB.filter(completed=True, completed_at__lte=cutoff) \
+                .using_db(db).order_by('order_id').limit(batch_size)
+            if not orders:
+                break
+            ids = [o.order_id for o in orders]
+            # сначала заказы попадают в архив, затем удаляются из таблицы: если перенос прервётся,
+            # повторный запуск перезапишет уже скопированные строки, и ни один заказ не пропадёт
+            await OrderArchiveDB.filter(order_id__in=ids).delete()
+            await OrderArchiveDB.bulk_create([
+                OrderArchiveDB(**{field: getattr(o, field) for field in OrderDB._meta.db_fields}) for o in orders
+            ])
+            await OrderDB.filter(order_id__in=ids).using_db(db).delete()
+            moved += len(ids)
+    return moved
+
+
+async def main(days: int):
+    await Tortoise.init(config=TORTOISE_ORM)
+    print(f'archived {await archive_orders(days)} orders')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос давно выполненных заказов в архив')
+    parser.add_argument('--days', type=int, default=30, help='сколько дней хранить выполненные заказы (30)')
+    run_async(main(parser.parse_args().days))
@@ -0,0 +1,84 @@
+import argparse
+from typing import List, Tuple
+from tortoise import Tortoise, run_async, timezone
+from tortoise.transactions import in_transaction
+
+from database import TORTOISE_ORM
+from models.courier import CourierDB
+from models.order import OrderDB
+from models.shards import fan_out, shard
+
+
+async def repair_courier(courier_id: int):
+    """
+    Приводит назначенные заказы курьера в соответствие с таблицей заказов. Заказ, который числится за курьером
+    в таблице заказов, но которого нет в его списке, - сирота: назначение записалось в шард, а курьер не сохранился
+    (его транзакция откатилась), поэтому курьер о заказе не знает и заказ освобождается. Заказ из списка,
+    который в таблице заказов за курьером не числится, из списка убирается. Проверка повторяется под блокировкой
+    строки курьера: назначение, которое ещё не зафиксировано, держит её, и его заказы не примутся за сирот
+    :param courier_id: id курьера
+    :return: None
+    """
+    async with in_transaction('default'):
+        courier = await CourierDB.select_for_update().get(courier_id=courier_id)
+        rows = await fan_out(
+            lambda db: OrderDB.filter(courier_id=courier_id, completed=False).using_db(db)
+            .values_list('order_id', 'weight', 'region')
+        )
+        claimed = {order_id: (weight, region) for order_id, weight, region in rows}
+        assigns = [i for i in courier.dump()['assigns'] if i in claimed]
+        orphans = [i for i in claimed if i not in assigns]
+        for order_id in orphans:
+            await OrderDB.filter(order_id=order_id, courier_id=courier_id, completed=False) \
+                .using_db(shard(claimed[order_id][1])).update(courier_id=None, updated_at=timezone.now())
+        await CourierDB.filter(courier_id=courier_id).update(
+            assigns=','.join(map(str, assigns)), assigned_weight=sum(claimed[i][0] for i in assigns)
+        )
+
+
+async def audit_assigned_weight(repair: bool = False, batch_size: int = 1000) -> List[Tuple[int, float, float]]:
+    """
+    Сверяет сохранённые у курьеров назначенные заказы и их вес с невыполненными заказами,
+    которые в таблице заказов (во всех шардах) числятся за курьером
+    :param repair: исправить расхождения (см. repair_courier)
+    :param batch_size: сколько курьеров проверяется за один шаг
+    :return: список расхождений (id курьера, сохранённый вес, вес заказов, которые числятся за ним в таблице заказов)
+    """
+    drift = []
+    after = None
+    while True:
+        query = CourierDB.all() if after is None else CourierDB.filter(courier_id__gt=after)
+        couriers = await query.order_by('courier_id').limit(batch_size)
+        if not couriers:
+            break
+        ids = [courier.courier_id for courier in couriers]
+        rows = await fan_out(
+            lambda db: OrderDB.filter(courier_id__in=ids, completed=False).using_db(db)
+            .values_list('courier_id', 'order_id', 'weight')
+        )
+        open_orders = dict()
+        for courier_id, order_id, weight in rows:
+            open_orders.setdefault(courier_id, dict())[order_id] = weight
+        for courier in couriers:
+            orders = open_orders.get(courier.courier_id, dict())
+            actual = sum(orders.values())
+            if abs(actual - courier.assigned_weight) > 1e-6 or set(courier.dump()['assigns']) != set(orders):
+                drift.append((courier.courier_id, courier.assigned_weight, actual))
+                if repair:
+                    await repair_courier(courier.courier_id)
+        after = couriers[-1].courier_id
+    return drift
+
+
+async def main(repair: bool):
+    await Tortoise.init(config=TORTOISE_ORM)
+    drift = await audit_assigned_weight(repair)
+    for courier_id, stored, actual in drift:
+        print(f'courier {courier_id}: stored {stored}, actual {actual}')
+    print(f'{len(drift)} couriers {"repaired" if repair else "with drift"}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Проверка веса назначенных курьерам заказов')
+    parser.add_argument('--repair', action='store_true', help='исправить расхождения')
+    run_async(main(parser.parse_args().repair))
@@ -0,0 +1,56 @@
+"""
+Профили многих курьеров: GET /couriers/{id} для каждого курьера против одного POST /couriers/query
+(sqlite в памяти, у каждого курьера выполненные заказы в нескольких районах).
+Запуск: python -m benchmarks.couriers_query [количество курьеров] [заказов на курьера]
+"""
+import asyncio
+import json
+import sys
+import time
+from tortoise import Tortoise
+
+
+async def run(couriers: int, orders: int):
+    import replay
+    from database import TORTOISE_ORM
+    from helpers import rate_limit
+    from main import app
+    from models.courier import CourierDB
+    from models.order import OrderDB
+
+    TORTOISE_ORM['connections'] = {'default': 'sqlite://:memory:'}
+    rate_limit.route_limits.clear()
+    await Tortoise.init(config=TORTOISE_ORM)
+    await Tortoise.generate_schemas()
+    await CourierDB.bulk_create([
+        CourierDB(courier_id=i, courier_type='car', regions='1,2,3', working_hours='09:00-18:00',
+                  completed=','.join(str(i * orders + j) for j in range(orders)))
+        for i in range(1, couriers + 1)
+    ], batch_size=1000)
+    await OrderDB.bulk_create([
+        OrderDB(order_id=i * orders + j, weight=1, region=1 + j % 3, delivery_hours='09:00-18:00', courier_id=i,
+                completed=True, complete_time=60 * (1 + j % 50))
+        for i in range(1, couriers + 1) for j in range(orders)
+    ], batch_size=1000)
+
+    def record(method, path, body=''):
+        return {'method': method, 'path': path, 'query': '', 'client': 'bench',
+                'headers': {'content-type': 'application/json'}, 'body': body}
+
+    start = time.perf_counter()
+    for i in range(1, couriers + 1):
+        assert await replay.call(app, record('GET', f'/couriers/{i}')) == 200
+    elapsed = time.perf_counter() - start
+    print(f'GET /couriers/{{id}} x {couriers:5}  {elapsed * 1000:8.1f} ms')
+
+    start = time.perf_counter()
+    body = json.dumps({'ids': list(range(1, couriers + 1))})
+    assert await replay.call(app, record('POST', '/couriers/query', body)) == 200
+    elapsed = time.perf_counter() - start
+    print(f'POST /couriers/query      {elapsed * 1000:8.1f} ms')
+    await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run(int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+                                                    int(sys.argv[2]) if len(sys.argv) > 2 else 20))
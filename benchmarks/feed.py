@@ -0,0 +1,84 @@
+"""
+Лента новых заказов при 10 000 подключённых курьеров: память на одно подключение и скорость рассылки.
+Каждое подключение - настоящий поток StreamingResponse(events(...)) маршрута /couriers/{id}/assignments/stream,
+запущенный как ASGI-приложение (генератор, задачи starlette, подписка и её буфер). Не учитываются только
+объекты сервера (сокет, протокол uvicorn и его буферы), они зависят от сервера и его настроек.
+Запуск: python -m benchmarks.feed [количество курьеров] [количество заказов]
+"""
+import asyncio
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from fastapi.responses import StreamingResponse
+
+from models.courier import Courier
+from models.feed import feed
+from uris.get_courier_assignments_stream import events
+
+
+class Connection:
+    """
+    Клиент потока: считает полученные события и отключается по команде
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.disconnected = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.body' and message.get('body', b'').startswith(b'event: order'):
+            self.received += 1
+
+
+async def run(couriers: int, orders: int):
+    random.seed(0)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/couriers/0/assignments/stream', 'headers': []}
+    connections = [Connection() for _ in range(couriers)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = []
+    for i, connection in enumerate(connections):
+        courier = Courier(courier_id=i, courier_type=random.choice(('foot', 'bike', 'car')),
+                          regions=random.sample(range(100), 3), working_hours=['09:00-13:00', '14:00-18:00'])
+        response = StreamingResponse(events(courier), media_type='text/event-stream')
+        tasks.append(asyncio.ensure_future(response(scope, connection.receive, connection.send)))
+    # ждём, пока все потоки отправят заголовки и подпишутся
+    while feed.stats()['subscriptions'] < couriers:
+        await asyncio.sleep(0.01)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'{couriers} connections: {memory / couriers:.0f} B/connection '
+          f'(stream, generator, tasks, subscription; without server socket and buffers)')
+
+    start = time.perf_counter()
+    for i in range(orders):
+        feed.publish(i, 1 + i % 40, i % 100, ['10:00-12:00'])
+    # события доходят до клиентов, когда потоки получают управление
+    delivered = -1
+    while delivered != sum(connection.received for connection in connections):
+        delivered = sum(connection.received for connection in connections)
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(f'{orders} orders published and delivered in {elapsed * 1000:.1f} ms ({orders / elapsed:.0f} orders/s), '
+          f'{delivered} events sent ({delivered / elapsed:.0f} events/s)')
+
+    for connection in connections:
+        connection.disconnected.set()
+    await asyncio.gather(*tasks)
+    # starlette отменяет задачу потока, не дожидаясь её: подписки снимаются, когда отмена дойдёт до генераторов
+    while feed.stats()['subscriptions']:
+        await asyncio.sleep(0.01)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    )
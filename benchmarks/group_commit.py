@@ -0,0 +1,73 @@
+"""
+Пропускная способность POST /orders/complete при одновременных запросах: фиксация каждого запроса отдельно
+против групповой фиксации с окном 2 и 5 мс (sqlite в файле во временной папке, WAL, fsync на каждый commit).
+Запуск: python -m benchmarks.group_commit [количество выполнений] [одновременных запросов]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from tortoise import Tortoise
+
+# заказов у одного курьера (выполнения одного курьера читают и меняют одну строку)
+ORDERS_PER_COURIER = 10
+
+
+async def run(count: int, concurrency: int):
+    import replay
+    from database import TORTOISE_ORM
+    from helpers import rate_limit
+    from main import app
+    from models.courier import CourierDB
+    from models.order import OrderDB
+    from models.group_commit import group_commit
+
+    rate_limit.route_limits.clear()
+    with tempfile.TemporaryDirectory() as directory:
+        TORTOISE_ORM['connections'] = {'default': f'sqlite://{os.path.join(directory, "bench.sqlite")}'}
+        await Tortoise.init(config=TORTOISE_ORM)
+        await Tortoise.generate_schemas()
+        first = 0
+        for window in (0, 0.002, 0.005):
+            ids = range(first, first + count)
+            first += count
+            now = datetime.utcnow()
+            await CourierDB.bulk_create([
+                CourierDB(courier_id=i, courier_type='car', regions='1', working_hours='09:00-18:00', assign_time=now,
+                          assigns=','.join(map(str, range(i, min(i + ORDERS_PER_COURIER, ids.stop)))),
+                          assigned_weight=ORDERS_PER_COURIER)
+                for i in ids[::ORDERS_PER_COURIER]
+            ], batch_size=1000)
+            await OrderDB.bulk_create([
+                OrderDB(order_id=i, weight=1, region=1, delivery_hours='09:00-18:00',
+                        courier_id=i - (i - ids.start) % ORDERS_PER_COURIER)
+                for i in ids
+            ], batch_size=1000)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def complete(order_id: int):
+                body = {'courier_id': order_id - (order_id - ids.start) % ORDERS_PER_COURIER, 'order_id': order_id,
+                        'complete_time': datetime.utcnow().isoformat()}
+                async with semaphore:
+                    return await replay.call(app, {'method': 'POST', 'path': '/orders/complete', 'query': '',
+                                                   'client': 'bench', 'body': json.dumps(body),
+                                                   'headers': {'content-type': 'application/json'}})
+
+            group_commit.window = window
+            committed = group_commit.committed
+            start = time.perf_counter()
+            statuses = await asyncio.gather(*(complete(i) for i in ids))
+            elapsed = time.perf_counter() - start
+            assert set(statuses) == {200}, statuses
+            name = f'group commit {window * 1000:.0f} ms' if window else 'commit per request'
+            batches = f'{group_commit.committed - committed} batches' if window else ''
+            print(f'{name:20} {count / elapsed:8.0f} completions/s  {batches}')
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                                                    int(sys.argv[2]) if len(sys.argv) > 2 else 50))
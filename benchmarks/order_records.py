@@ -0,0 +1,43 @@
+"""
+Сравнение pydantic-модели Order и внутреннего OrderRecord на 100 000 заказов:
+время создания и объём памяти на один заказ.
+Запуск: python -m benchmarks.order_records
+"""
+import time
+import tracemalloc
+
+from models.order import Order, OrderRecord
+
+COUNT = 100000
+
+
+def rows():
+    # строки в том виде, в котором их возвращает OrderDB.values_list(*OrderRecord.fields)
+    return [(i, 1 + i % 40, i % 100, '09:00-12:00,16:00-21:30', None, False, None) for i in range(COUNT)]
+
+
+def as_order(row):
+    return Order(
+        order_id=row[0], weight=row[1], region=row[2], delivery_hours=row[3].split(','),
+        courier_id=row[4], completed=row[5], complete_time=row[6]
+    )
+
+
+def measure(name, build):
+    data = rows()
+    start = time.perf_counter()
+    objects = [build(row) for row in data]
+    elapsed = time.perf_counter() - start
+    del objects
+
+    tracemalloc.start()
+    objects = [build(row) for row in data]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    print(f'{name:12} {elapsed:8.3f} s  {elapsed / COUNT * 1e6:8.2f} us/order  {memory / COUNT:8.1f} B/order')
+
+
+if __name__ == '__main__':
+    measure('Order', as_order)
+    measure('OrderRecord', lambda row: OrderRecord(*row))
@@ -0,0 +1,68 @@
+"""
+Выборка кандидатов для назначения на одном и на нескольких шардах заказов (файлы sqlite во временной папке).
+Каждая конфигурация запускается в отдельном процессе, так как шарды задаются переменной окружения ORDER_SHARDS.
+Запуск: python -m benchmarks.shards [количество заказов] [количество курьеров]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+WORKER = '''
+import asyncio, random, sys, time
+from tortoise import Tortoise
+from tortoise.query_utils import Q
+from database import TORTOISE_ORM
+from models.order import OrderDB, OrderRecord
+from models.shards import shard, create_order_tables
+from helpers.time_translate import hours_to_bitmap, bitmap_to_buckets
+
+ORDERS, COURIERS = int(sys.argv[1]), int(sys.argv[2])
+BUCKETS = bitmap_to_buckets(hours_to_bitmap(['09:00-18:00']))
+
+
+async def main():
+    await Tortoise.init(config=TORTOISE_ORM)
+    await Tortoise.generate_schemas(safe=True)
+    await create_order_tables()
+    by_shard = dict()
+    for i in range(ORDERS):
+        order = OrderDB(order_id=i, weight=1 + i % 40, region=i % 100, delivery_hours='09:00-18:00',
+                        delivery_buckets=BUCKETS)
+        by_shard.setdefault(shard(order.region), []).append(order)
+    for db, orders in by_shard.items():
+        await OrderDB.bulk_create(orders, batch_size=1000, using_db=db)
+
+    random.seed(0)
+    couriers = [random.sample(range(100), 3) for _ in range(COURIERS)]
+
+    async def candidates(regions):
+        return await OrderRecord.fetch(
+            Q(region__in=regions) & Q(weight__lte=50) & Q(courier_id__isnull=True) & Q(completed=False),
+            regions=regions
+        )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(candidates(regions) for regions in couriers))
+    print(time.perf_counter() - start)
+    await Tortoise.close_connections()
+
+asyncio.get_event_loop().run_until_complete(main())
+'''
+
+
+def run(orders: int, couriers: int):
+    project = os.getcwd()
+    for count in (1, 2, 4):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = ','.join(f'sqlite://{os.path.join(directory, f"shard{i}.sqlite")}' for i in range(count))
+            env = dict(os.environ, DB='', ORDER_SHARDS=urls, PYTHONPATH=project)
+            output = subprocess.run([sys.executable, '-c', WORKER, str(orders), str(couriers)], cwd=directory,
+                                    env=env, check=True, capture_output=True, text=True).stdout
+            elapsed = float(output.split()[-1])
+            print(f'{count} shard(s): {couriers} candidate queries in {elapsed * 1000:8.1f} ms '
+                  f'({elapsed / couriers * 1000:.2f} ms/query)')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,42 @@
+"""
+Замер холодного старта воркера: время импорта приложения и задержка первого запроса.
+Каждый замер выполняется в отдельном процессе, как при запуске нового воркера gunicorn.
+Запуск: python -m benchmarks.startup [количество запусков]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+WORKER = '''
+import time
+start = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app) as client:
+    ready = time.perf_counter()
+    client.get('/couriers/1')
+    first = time.perf_counter()
+print(imported - start, ready - imported, first - ready)
+'''
+
+
+def run(runs: int):
+    project = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # БД (sqlite://db.sqlite) создаётся во временной папке один раз заранее, как это делает prestart.sh
+        env = dict(os.environ, DB='', GENERATE_SCHEMAS='', PYTHONPATH=project)
+        subprocess.run([sys.executable, os.path.join(project, 'migrate.py')], cwd=directory, env=env, check=True)
+        results = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', WORKER], cwd=directory, env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            results.append([float(i) for i in output.split()[-3:]])
+    for name, values in zip(('import', 'startup', 'first request'), zip(*results)):
+        values = sorted(values)
+        print(f'{name:14} median {values[len(values) // 2] * 1000:8.1f} ms  max {values[-1] * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,95 @@
+"""
+Проверка пересечения времени доставки заказов с временем работы курьера:
+интервалы (time_to_int_intervals + intervals_overlap) против масок минут (hours_to_bitmap + побитовое И),
+а также сколько строк отсекает фильтр по корзинам времени в SQL (sqlite в памяти).
+Запуск: python -m benchmarks.time_bitmaps [количество заказов]
+"""
+import asyncio
+import random
+import sys
+import time
+from typing import List
+from tortoise import Tortoise
+
+from helpers.time_translate import time_to_int_intervals, hours_to_bitmap, bitmap_to_buckets, bitmap_to_bytes, \
+    bytes_to_bitmap
+
+WORKING_HOURS = ['09:00-11:00', '14:00-15:30']
+
+
+def intervals_overlap(interval: List[int], intervals: List[List[int]]) -> bool:
+    """
+    Проверяет, пересекается ли интервал хотя бы с одним из интервалов (прежняя проверка, до масок минут)
+    :param interval: Интервал в int [с, до] (int - минуты)
+    :param intervals: Интервалы в int (int - минуты)
+    :return: bool
+    """
+    for i in intervals:
+        if (i[0] <= interval[0] <= i[1]
+                or i[0] <= interval[1] <= i[1]
+                or interval[0] <= i[0] <= interval[1]
+                or interval[0] <= i[1] <= interval[1]):
+            return True
+    return False
+
+
+def random_hours():
+    hours = []
+    for _ in range(random.randint(1, 3)):
+        start = random.randrange(0, 23 * 60)
+        end = min(start + random.randrange(15, 180), 23 * 60 + 59)
+        hours.append(f'{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}')
+    return hours
+
+
+def measure(name, check, orders):
+    start = time.perf_counter()
+    matched = sum(1 for order in orders if check(order))
+    elapsed = time.perf_counter() - start
+    print(f'{name:28} {elapsed:8.3f} s  {elapsed / len(orders) * 1e6:8.2f} us/order  {matched} matched')
+
+
+def compare(count: int):
+    random.seed(0)
+    orders = [random_hours() for _ in range(count)]
+    working_intervals = time_to_int_intervals(WORKING_HOURS)
+    working_bitmap = hours_to_bitmap(WORKING_HOURS)
+
+    measure('intervals', lambda hours: any(
+        intervals_overlap(interval, working_intervals) for interval in time_to_int_intervals(hours)
+    ), orders)
+    measure('bitmap', lambda hours: hours_to_bitmap(hours) & working_bitmap, orders)
+    # в снимке свободных заказов маски посчитаны заранее, остаётся только побитовое И
+    bitmaps = [hours_to_bitmap(hours) for hours in orders]
+    measure('bitmap (precomputed)', lambda bitmap: bitmap & working_bitmap, bitmaps)
+    # подбор заказов читает маску из колонки delivery_bitmap и только распаковывает её
+    stored = [bitmap_to_bytes(bitmap) for bitmap in bitmaps]
+    measure('bitmap (stored)', lambda data: bytes_to_bitmap(data) & working_bitmap, stored)
+    intervals = [time_to_int_intervals(hours) for hours in orders]
+    measure('intervals (precomputed)', lambda order: any(
+        intervals_overlap(interval, working_intervals) for interval in order
+    ), intervals)
+    return orders
+
+
+async def sql(orders):
+    from models.order import OrderDB, OrderRecord
+    await Tortoise.init(db_url='sqlite://:memory:', modules={'models': ['models.order']})
+    await Tortoise.generate_schemas()
+    await OrderDB.bulk_create([
+        OrderDB(order_id=i, weight=1, region=1, delivery_hours=','.join(hours),
+                delivery_buckets=bitmap_to_buckets(hours_to_bitmap(hours)))
+        for i, hours in enumerate(orders)
+    ], batch_size=1000)
+    buckets = bitmap_to_buckets(hours_to_bitmap(WORKING_HOURS))
+    for name, kwargs in (('sql without buckets', {}), ('sql with buckets', {'buckets': buckets})):
+        start = time.perf_counter()
+        rows = await OrderRecord.fetch(region=1, completed=False, **kwargs)
+        elapsed = time.perf_counter() - start
+        print(f'{name:28} {elapsed:8.3f} s  {len(rows)} rows loaded')
+    await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    data = compare(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    asyncio.get_event_loop().run_until_complete(sql(data))
@@ -0,0 +1,74 @@
+"""
+Цена трассировки: вызов метода модели с декоратором traced без трассировки против исходной функции,
+и задержка запросов через приложение (sqlite в памяти) без трассировки и с записью спанов в файл.
+Запуск: python -m benchmarks.tracing [количество запросов]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from tortoise import Tortoise
+
+from helpers.tracing import TracingMiddleware, tracer, trace_connections
+
+COURIER = b'{"data": [{"courier_id": %d, "courier_type": "car", "regions": [1], "working_hours": ["09:00-18:00"]}]}'
+ORDER = b'{"data": [{"order_id": %d, "weight": 1, "region": 1, "delivery_hours": ["10:00-11:00"]}]}'
+
+
+def calls(count: int):
+    from models.courier import Courier
+    from models.order import OrderRecord
+    courier = Courier(courier_id=1, courier_type='car', regions=[1], working_hours=['09:00-18:00'])
+    orders = [OrderRecord(i, 1, 1, '10:00-11:00') for i in range(10)]
+    for name, match in (('match (original)', Courier.match.__wrapped__), ('match (traced, off)', Courier.match)):
+        start = time.perf_counter()
+        for _ in range(count):
+            match(courier, orders)
+        elapsed = time.perf_counter() - start
+        print(f'{name:28} {elapsed / count * 1e6:8.2f} us/call')
+
+
+async def requests(count: int):
+    import replay
+    from database import TORTOISE_ORM
+    from helpers import rate_limit
+    from main import app
+
+    TORTOISE_ORM['connections'] = {'default': 'sqlite://:memory:'}
+    rate_limit.route_limits.clear()
+    await Tortoise.init(config=TORTOISE_ORM)
+    await Tortoise.generate_schemas()
+
+    def record(method, path, body=b''):
+        return {'method': method, 'path': path, 'query': '', 'client': 'bench',
+                'headers': {'content-type': 'application/json'}, 'body': body.decode()}
+
+    async def measure(name, target):
+        start = time.perf_counter()
+        for i in range(count):
+            assert await replay.call(target, record('POST', '/couriers', COURIER % (i + 1))) == 201
+            assert await replay.call(target, record('POST', '/orders', ORDER % (i + 1))) == 201
+            assert await replay.call(target, record('POST', '/orders/assign', b'{"courier_id": %d}' % (i + 1))) == 200
+            await replay.call(target, record('GET', f'/couriers/{i + 1}'))
+        elapsed = time.perf_counter() - start
+        print(f'{name:28} {elapsed / count / 4 * 1000:8.3f} ms/request')
+        for model in Tortoise.apps['models'].values():
+            await model.all().delete()
+
+    await measure('requests (tracing off)', app)
+    with tempfile.TemporaryDirectory() as directory:
+        tracer.path = os.path.join(directory, 'trace.log')
+        trace_connections()
+        traced_app = TracingMiddleware(app, routes=app.router.routes)
+        await measure('requests (tracing off, db)', app)
+        await measure('requests (tracing on)', traced_app)
+        tracer.file.close()
+        print(f'{os.path.getsize(tracer.path) / count / 4:.0f} bytes of spans/request')
+    await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    calls(number * 100)
+    asyncio.get_event_loop().run_until_complete(requests(number))
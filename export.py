@@ -0,0 +1,35 @@
+import argparse
+from datetime import datetime
+from typing import Optional
+from tortoise import Tortoise, run_async, timezone
+
+from database import TORTOISE_ORM
+from models.export import export_csv
+
+
+async def export(table: str, output: str, since: Optional[datetime]):
+    """
+    Выгружает таблицу в CSV-файл, для заказов печатает водяной знак следующей инкрементальной выгрузки
+    :param table: 'orders' или 'couriers'
+    :param output: путь к файлу
+    :param since: водяной знак предыдущей выгрузки заказов (None - выгрузить всё)
+    :return: None
+    """
+    await Tortoise.init(config=TORTOISE_ORM)
+    watermark = timezone.now().isoformat()
+    with open(output, 'w', newline='') as file:
+        async for chunk in export_csv(table, since):
+            file.write(chunk)
+    if table == 'orders':
+        print(watermark)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Выгрузка заказов и курьеров в CSV для аналитики')
+    parser.add_argument('table', choices=('orders', 'couriers'))
+    parser.add_argument('--output', help='файл для выгрузки (по умолчанию <table>.csv)')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='водяной знак предыдущей выгрузки')
+    args = parser.parse_args()
+    if args.table == 'couriers' and args.since is not None:
+        parser.error('couriers are exported only in full, --since is supported for orders')
+    run_async(export(args.table, args.output or f'{args.table}.csv', args.since))
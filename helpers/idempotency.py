@@ -0,0 +1,77 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+# Сохранённый ответ: (статус, тело, media type, хеш тела запроса)
+Stored = Tuple[int, bytes, str, str]
+
+
+class LRUStore:
+    """
+    Ограниченное по размеру хранилище ответов в памяти процесса. Вытесняются давно не использованные ключи.
+    Любой объект с такими же методами get/set можно подставить вместо него (например, обёртку над внешним KV)
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.items: 'OrderedDict[Tuple[str, str], Stored]' = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Stored]:
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def set(self, key: Tuple[str, str], value: Stored):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+store = LRUStore(int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000)))
+# запросы с ключом, которые выполняются прямо сейчас: повтор дожидается первого запроса, а не выполняется заново
+pending: Dict[Tuple[str, str], asyncio.Future] = dict()
+
+
+async def idempotent(scope: str, key: Optional[str], request: BaseModel,
+                     handler: Callable[[], Awaitable]) -> Response:
+    """
+    Выполняет обработчик запроса не больше одного раза для каждого Idempotency-Key,
+    повторные запросы с тем же ключом получают сохранённый ответ без обращения к БД
+    :param scope: путь эндпоинта (ключи разных эндпоинтов не пересекаются)
+    :param key: значение заголовка Idempotency-Key (None - запрос выполняется как обычно)
+    :param request: тело запроса. Запрос с тем же ключом, но другим телом получает 422, а не чужой ответ
+    :param handler: обработчик запроса
+    :return: ответ
+    """
+    if key is None:
+        return await handler()
+    key = (scope, key)
+    digest = hashlib.sha256(request.json().encode()).hexdigest()
+    stored = store.get(key)
+    while stored is None and key in pending:
+        # запрос с этим ключом уже выполняется - дожидаемся его ответа
+        stored = await asyncio.shield(pending[key])
+    if stored is not None:
+        if stored[3] != digest:
+            return JSONResponse(status_code=422, content={'detail': 'Idempotency-Key was used with another request'})
+        return Response(content=stored[1], status_code=stored[0], media_type=stored[2])
+
+    future = pending[key] = asyncio.get_event_loop().create_future()
+    try:
+        response = await handler()
+        if not isinstance(response, Response):
+            response = JSONResponse(content=jsonable_encoder(response))
+        stored = (response.status_code, response.body, response.media_type, digest)
+        store.set(key, stored)
+        return response
+    finally:
+        # если обработчик упал, ожидающие запросы получат None и выполнят его сами
+        del pending[key]
+        future.set_result(stored)
@@ -0,0 +1,147 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from fastapi.responses import JSONResponse
+
+# Лимиты дорогих маршрутов: "МЕТОД путь=запросов в секунду от клиента/размер пачки/одновременных запросов"
+# через запятую. По умолчанию ограничений нет
+RATE_LIMITS = os.getenv('RATE_LIMITS', '')
+# Адреса прокси через запятую: за ними клиент определяется по X-Forwarded-For, иначе все клиенты
+# за прокси делили бы одну корзину. Заголовку от остальных адресов не доверяем - его может подставить сам клиент
+RATE_LIMIT_TRUSTED_PROXIES = set(filter(None, map(str.strip, os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '').split(','))))
+# Сколько клиентов помнит каждый маршрут (давно не приходившие вытесняются)
+RATE_LIMIT_CLIENTS = int(os.getenv('RATE_LIMIT_CLIENTS', 10000))
+
+
+class RouteLimit:
+    """
+    Ограничения одного маршрута: token bucket для каждого клиента и общий предел одновременных запросов
+    """
+
+    def __init__(self, method: str, path: str, rate: float, burst: int, concurrency: int):
+        self.route = f'{method} {path}'
+        self.method = method
+        # {id} в пути совпадает с любым сегментом
+        self.pattern = re.compile('^' + re.sub(r'\\{\w+\\}', '[^/]+', re.escape(path)) + '$')
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.buckets: 'OrderedDict[str, List[float]]' = OrderedDict()  # клиент -> [токены, время обновления]
+        self.active = 0
+        self.allowed = 0
+        self.limited = 0    # отклонено с 429 (клиент превысил свой лимит)
+        self.shed = 0       # отклонено с 503 (маршрут занят)
+
+    def take(self, client: str) -> bool:
+        """
+        Забирает токен из корзины клиента
+        :param client: адрес клиента (см. client_address)
+        :return: True - запрос можно выполнять, False - лимит исчерпан
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = [self.burst, now]
+            if len(self.buckets) > RATE_LIMIT_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+def parse_limits(value: str) -> List[RouteLimit]:
+    """
+    Разбирает настройку RATE_LIMITS
+    :param value: строка вида "POST /orders/assign=10/20/50,GET /couriers/{id}=50/100/100"
+    :return: список ограничений
+    """
+    limits = []
+    for item in filter(None, map(str.strip, value.split(','))):
+        route, numbers = item.rsplit('=', 1)
+        method, path = route.split()
+        rate, burst, concurrency = numbers.split('/')
+        limits.append(RouteLimit(method.upper(), path, float(rate), int(burst), int(concurrency)))
+    return limits
+
+
+def client_address(scope, trusted_proxies: Set[str]) -> str:
+    """
+    Определяет адрес клиента запроса
+    :param scope: ASGI scope запроса
+    :param trusted_proxies: адреса прокси, которым доверяем X-Forwarded-For
+    :return: адрес подключения или, за доверенным прокси, последний адрес X-Forwarded-For не из списка прокси
+    """
+    address = scope['client'][0] if scope.get('client') else ''
+    if address not in trusted_proxies:
+        return address
+    forwarded = [value for name, value in scope.get('headers', []) if name == b'x-forwarded-for']
+    # каждый прокси дописывает адрес своего клиента в конец, поэтому адреса проверяются справа налево
+    for hop in reversed(b','.join(forwarded).decode('latin-1').split(',')):
+        address = hop.strip()
+        if address and address not in trusted_proxies:
+            break
+    return address
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware: запросы сверх лимита клиента сразу получают 429, а сверх предела одновременных
+    запросов маршрута - 503, вместо того чтобы ждать в очереди к пулу соединений БД
+    """
+
+    def __init__(self, app, limits: Optional[List[RouteLimit]] = None, trusted_proxies: Optional[Set[str]] = None):
+        self.app = app
+        self.limits = route_limits if limits is None else limits
+        self.trusted_proxies = RATE_LIMIT_TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+
+    def match(self, method: str, path: str) -> Optional[RouteLimit]:
+        for limit in self.limits:
+            if limit.method == method and limit.pattern.match(path):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        limit = self.match(scope['method'], scope['path']) if scope['type'] == 'http' else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        client = client_address(scope, self.trusted_proxies)
+        if not limit.take(client):
+            limit.limited += 1
+            response = JSONResponse({'detail': 'Too Many Requests'}, status_code=429,
+                                    headers={'Retry-After': str(max(1, round(1 / limit.rate))) if limit.rate else '1'})
+        elif limit.active >= limit.concurrency:
+            limit.shed += 1
+            response = JSONResponse({'detail': 'Service Unavailable'}, status_code=503, headers={'Retry-After': '1'})
+        else:
+            limit.allowed += 1
+            limit.active += 1
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                limit.active -= 1
+            return
+        await response(scope, receive, send)
+
+
+route_limits = parse_limits(RATE_LIMITS)
+
+
+def stats() -> Dict[str, dict]:
+    """
+    Возвращает счётчики и настройки ограничений по каждому маршруту
+    :return: dict
+    """
+    return {
+        limit.route: {
+            'allowed': limit.allowed, 'limited': limit.limited, 'shed': limit.shed, 'active': limit.active,
+            'rate': limit.rate, 'burst': limit.burst, 'concurrency': limit.concurrency
+        } for limit in route_limits
+    }
@@ -0,0 +1,80 @@
+import base64
+import os
+import json
+import time
+
+# Файл, в который записываются входящие запросы для последующего воспроизведения (replay.py). Пусто - не записывать
+RECORD_REQUESTS = os.getenv('RECORD_REQUESTS', '')
+# Заголовки, которые влияют на обработку запроса и поэтому сохраняются
+RECORDED_HEADERS = ('content-type', 'idempotency-key')
+
+
+def encode_body(body: bytes) -> dict:
+    """
+    Сохраняет тело запроса без потерь: тело в UTF-8 - строкой (его удобно читать и править),
+    любое другое - в base64
+    :param body: тело запроса
+    :return: {"body": строка} или {"body_base64": строка}
+    """
+    try:
+        return {'body': body.decode()}
+    except UnicodeDecodeError:
+        return {'body_base64': base64.b64encode(body).decode('ascii')}
+
+
+def decode_body(record: dict) -> bytes:
+    """
+    Восстанавливает тело запроса, сохранённое encode_body
+    :param record: записанный запрос
+    :return: тело запроса
+    """
+    if 'body_base64' in record:
+        return base64.b64decode(record['body_base64'])
+    return record['body'].encode()
+
+
+class RecordMiddleware:
+    """
+    ASGI middleware: дописывает каждый HTTP-запрос одной JSON-строкой в файл
+    {"ts": время, "method": ..., "path": ..., "query": ..., "headers": {...}, "client": ..., "body": ...}
+    (тело не в UTF-8 записывается в "body_base64", см. encode_body)
+    """
+
+    def __init__(self, app, path: str = ''):
+        self.app = app
+        self.file = open(path or RECORD_REQUESTS, 'a')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        ts = time.time()
+        # тело читается целиком до обработки, обработчик получает его тем же одним сообщением
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+        headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+        self.file.write(json.dumps({
+            'ts': ts,
+            'method': scope['method'],
+            'path': scope['path'],
+            'query': scope['query_string'].decode('latin-1'),
+            'headers': {k: headers[k] for k in RECORDED_HEADERS if k in headers},
+            'client': scope['client'][0] if scope.get('client') else '',
+            **encode_body(body)
+        }, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+        sent = False
+
+        async def replay_body():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        await self.app(scope, replay_body, send)
@@ -23,3 +23,63 @@ def time_to_int_intervals(intervals: List[str]) -> List[List[int]]:
         intervals = list((intervals, ))
     return list(map(lambda x: [int(x[0:2]) * 60 + int(x[3:5]), int(x[6:8]) * 60 + int(x[9:11])], intervals))
 
+
+# Минут в сутках (бит в точной маске времени)
+DAY_MINUTES = 1440
+# Размер точной маски в байтах (в таком виде она хранится в БД)
+BITMAP_BYTES = DAY_MINUTES // 8
+# Размер корзины грубой маски (в минутах): 48 корзин помещаются в BIGINT и проверяются прямо в SQL
+BUCKET_MINUTES = 30
+
+
+def hours_to_bitmap(intervals: List[str]) -> int:
+    """
+    Превращает интервалы вида ["12:00-15:00"] в маску минут суток: бит i выставлен, если минута i входит
+    хотя бы в один интервал (границы включаются). Интервал через полночь ("22:00-02:00") занимает конец
+    и начало суток. Два набора интервалов пересекаются, если побитовое И их масок не равно нулю
+    :param intervals: Интервалы в str
+    :return: маска из 1440 бит
+    """
+    bitmap = 0
+    for start, end in time_to_int_intervals(intervals):
+        if start <= end:
+            bitmap |= ((1 << (end - start + 1)) - 1) << start
+        else:
+            bitmap |= (((1 << (DAY_MINUTES - start)) - 1) << start) | ((1 << (end + 1)) - 1)
+    return bitmap
+
+
+def bitmap_to_buckets(bitmap: int) -> int:
+    """
+    Сжимает маску минут в маску корзин по BUCKET_MINUTES минут: корзина выставлена, если в ней занята хотя бы
+    одна минута. Пересечение корзин необходимо, но не достаточно для пересечения интервалов
+    :param bitmap: маска минут
+    :return: маска из 48 бит
+    """
+    buckets = 0
+    bucket = (1 << BUCKET_MINUTES) - 1
+    k = 0
+    while bitmap:
+        if bitmap & bucket:
+            buckets |= 1 << k
+        bitmap >>= BUCKET_MINUTES
+        k += 1
+    return buckets
+
+
+def bitmap_to_bytes(bitmap: int) -> bytes:
+    """
+    Упаковывает маску минут в байты для хранения в БД (младший бит - минута 0)
+    :param bitmap: маска минут
+    :return: BITMAP_BYTES байт
+    """
+    return bitmap.to_bytes(BITMAP_BYTES, 'little')
+
+
+def bytes_to_bitmap(data: bytes) -> int:
+    """
+    Распаковывает маску минут, сохранённую bitmap_to_bytes
+    :param data: байты из БД
+    :return: маска минут
+    """
+    return int.from_bytes(data, 'little')
@@ -0,0 +1,279 @@
+import os
+import re
+import json
+import random
+import time
+import functools
+import inspect
+import contextvars
+from contextlib import contextmanager
+from typing import List, Optional
+from starlette.routing import Match
+
+# Файл, в который пишутся трассы (по одной на строку в формате OTLP/JSON). Пусто - трассировка выключена
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+# Название сервиса в ресурсе трасс (service.name)
+SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'candy-delivery')
+# Доля запросов, которые трассируются (запрос с заголовком traceparent следует решению вызывающей стороны)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1))
+
+# название инструментирующей библиотеки (scope) в OTLP
+SCOPE_NAME = 'helpers.tracing'
+# виды спанов OpenTelemetry
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+# методы клиента БД, вокруг которых создаются спаны запросов
+DB_METHODS = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many', 'execute_script')
+
+
+def attributes_to_otlp(attributes: dict) -> List[dict]:
+    """
+    Переводит атрибуты в формат OTLP/JSON
+    :param attributes: {'http.status_code': 200}
+    :return: [{'key': 'http.status_code', 'value': {'intValue': '200'}}]
+    """
+    result = []
+    for key, value in attributes.items():
+        # 64-битные целые в OTLP/JSON передаются строкой
+        if isinstance(value, bool):
+            value = {'boolValue': value}
+        elif isinstance(value, int):
+            value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            value = {'doubleValue': value}
+        else:
+            value = {'stringValue': str(value)}
+        result.append({'key': key, 'value': value})
+    return result
+
+
+class Span:
+    """
+    Спан: операция внутри трассы с временем начала и конца
+    """
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace: 'Trace', name: str, parent_id: str = '', kind: int = INTERNAL, attributes=None):
+        self.trace = trace
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+        trace.spans.append(self)
+
+    def dump(self) -> dict:
+        """
+        Возвращает спан в формате OTLP/JSON (время в наносекундах - строкой)
+        :return: dict
+        """
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': attributes_to_otlp(self.attributes),
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 0}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class Trace:
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or '%032x' % random.getrandbits(128)
+        self.spans: List[Span] = []
+
+    def dump(self) -> dict:
+        """
+        Возвращает трассу как запрос экспорта OTLP/JSON (ExportTraceServiceRequest)
+        :return: dict
+        """
+        return {'resourceSpans': [{
+            'resource': {'attributes': attributes_to_otlp({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': SCOPE_NAME}, 'spans': [span.dump() for span in self.spans]}]
+        }]}
+
+
+# текущий спан запроса (None - запрос не трассируется, и вложенные спаны не создаются)
+current: contextvars.ContextVar = contextvars.ContextVar('span', default=None)
+
+
+class Tracer:
+    """
+    Минимальный трассировщик в формате OpenTelemetry: спаны одной трассы копятся в памяти
+    и дописываются в файл одной строкой OTLP/JSON, когда заканчивается корневой спан
+    """
+
+    def __init__(self, path: str = '', sample_rate: float = 1):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.file = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def sampled(self, traceparent: Optional[str]) -> Optional[Trace]:
+        """
+        Решает, трассируется ли запрос
+        :param traceparent: заголовок W3C traceparent ("00-<trace id>-<span id>-<флаги>") или None
+        :return: трасса или None
+        """
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32 and re.fullmatch('[0-9a-f]{2}', parts[3]):
+                return Trace(parts[1]) if int(parts[3], 16) & 1 else None
+        if random.random() < self.sample_rate:
+            return Trace()
+        return None
+
+    @contextmanager
+    def span(self, name: str, kind: int = INTERNAL, **attributes):
+        """
+        Создаёт вложенный спан, если текущий запрос трассируется
+        :param name: название операции
+        :param kind: вид спана
+        :param attributes: атрибуты спана
+        """
+        parent = current.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, parent.span_id, kind, attributes)
+        token = current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.end = time.time_ns()
+            current.reset(token)
+
+    def export(self, trace: Trace):
+        """
+        Дописывает трассу в файл
+        :return: None
+        """
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(trace.dump()) + '\n')
+        self.file.flush()
+
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE)
+
+
+def traced(function):
+    """
+    Декоратор: оборачивает вызов функции (обычной или асинхронной) в спан с её именем, если запрос трассируется.
+    Без трассировки стоит одной проверки contextvar
+    """
+    name = function.__qualname__
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if current.get() is None:
+                return await function(*args, **kwargs)
+            with tracer.span(name):
+                return await function(*args, **kwargs)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current.get() is None:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+    return wrapper
+
+
+def trace_db_client(client_class):
+    """
+    Оборачивает методы клиента БД в спаны запросов (с текстом запроса в db.statement)
+    :param client_class: класс подключения tortoise
+    :return: None
+    """
+    for method in DB_METHODS:
+        original = getattr(client_class, method, None)
+        if original is None or getattr(original, 'traced', False):
+            continue
+
+        def wrap(original):
+            @functools.wraps(original)
+            async def wrapper(self, query, *args, **kwargs):
+                if current.get() is None:
+                    return await original(self, query, *args, **kwargs)
+                with tracer.span(query.split(None, 1)[0].upper() if query else 'query', CLIENT,
+                                 **{'db.name': self.connection_name, 'db.statement': query[:1000]}):
+                    return await original(self, query, *args, **kwargs)
+            wrapper.traced = True
+            return wrapper
+
+        setattr(client_class, method, wrap(original))
+
+
+def trace_connections():
+    """
+    Включает спаны запросов для всех подключений tortoise (и их обёрток транзакций)
+    :return: None
+    """
+    from tortoise import Tortoise
+    classes = {type(connection) for connection in Tortoise._connections.values()}
+    while classes:
+        client_class = classes.pop()
+        trace_db_client(client_class)
+        classes.update(client_class.__subclasses__())
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware: корневой спан на каждый HTTP-запрос с названием маршрута ("POST /orders/assign")
+    """
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+
+    def route(self, scope) -> str:
+        for route in self.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route.path
+        return scope['path']
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        traceparent = dict(scope['headers']).get(b'traceparent', b'').decode('latin-1')
+        trace = tracer.sampled(traceparent)
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+        # спан вызывающей стороны становится родителем, если трасса продолжена по её заголовку
+        parent_id = traceparent.split('-')[2] if trace.trace_id in traceparent else ''
+        span = Span(trace, f"{scope['method']} {self.route(scope)}", parent_id, SERVER,
+                    {'http.method': scope['method'], 'http.target': scope['path']})
+
+        async def traced_send(message):
+            if message['type'] == 'http.response.start':
+                span.attributes['http.status_code'] = message['status']
+            await send(message)
+
+        token = current.set(span)
+        try:
+            await self.app(scope, receive, traced_send)
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            current.reset(token)
+            span.end = time.time_ns()
+            tracer.export(trace)
@@ -2,7 +2,14 @@ from fastapi import FastAPI
 import os
 from tortoise.contrib.fastapi import register_tortoise
 
+from database import TORTOISE_ORM
 from routes import router
+from models.open_orders import open_orders
+from models.shards import create_order_tables
+from models.courier_types import courier_types
+from helpers.rate_limit import RateLimitMiddleware
+from helpers.recorder import RecordMiddleware, RECORD_REQUESTS
+from helpers.tracing import TracingMiddleware, tracer, trace_connections
 
 app = FastAPI(
     title='Сласти от всех напастей',
@@ -12,19 +19,54 @@ app = FastAPI(
     redoc_url=os.getenv('REDOC_URL', '/redoc'),
 )
 
-print('i`m working!')
-DB = os.getenv('DB', False)
-DB_USER = os.getenv('DB_USER', '')
-DB_PASSWORD = os.getenv('DB_PASSWORD', '')
-DB_HOSTNAME = os.getenv('DB_HOSTNAME', '')
-DB_PORT = os.getenv('DB_PORT', '')
-DB_NAME = os.getenv('DB_NAME', '')
+# схемы создаются отдельно через migrate.py, при каждом запуске воркера их генерировать не нужно
+# (только для разработки и тестов: GENERATE_SCHEMAS=1)
+GENERATE_SCHEMAS = os.getenv('GENERATE_SCHEMAS', '').lower() in ('1', 'true', 'yes')
 
 register_tortoise(
     app=app,
-    db_url=f'{DB}://{DB_USER}:{DB_PASSWORD}@{DB_HOSTNAME}:{DB_PORT}/{DB_NAME}' if DB else 'sqlite://db.sqlite',
-    # db_url=f'{DB}://{DB_USER}:{DB_PASSWORD}@{DB_HOSTNAME}:{DB_PORT}/{DB_NAME}' if DB else 'sqlite://:memory:',
-    modules={'models': ['models.courier', 'models.order']},
-    generate_schemas=True
+    config=TORTOISE_ORM,
+    generate_schemas=GENERATE_SCHEMAS
 )
 app.include_router(router)
+# ограничение частоты и числа одновременных запросов к дорогим маршрутам (см. RATE_LIMITS)
+app.add_middleware(RateLimitMiddleware)
+# трассировка запросов в формате OpenTelemetry (см. TRACE_FILE)
+if tracer.enabled:
+    app.add_middleware(TracingMiddleware, routes=app.router.routes)
+# запись входящих запросов для replay.py
+if RECORD_REQUESTS:
+    app.add_middleware(RecordMiddleware)
+
+
+@app.on_event('startup')
+async def create_shard_tables():
+    # вместе со схемой основной БД создаются таблицы заказов в шардах
+    if GENERATE_SCHEMAS:
+        await create_order_tables()
+
+
+@app.on_event('startup')
+async def trace_queries():
+    # спаны запросов к БД добавляются только при включённой трассировке
+    if tracer.enabled:
+        trace_connections()
+
+
+@app.on_event('startup')
+async def load_courier_types():
+    # типы курьеров читаются из БД один раз, дальше назначение и оплата берут их из памяти
+    await courier_types.load()
+
+
+@app.on_event('startup')
+async def load_open_orders():
+    # снимок свободных заказов загружается заранее, чтобы первый запрос на назначение не ждал его загрузки
+    if open_orders.enabled:
+        await open_orders.refresh()
+        open_orders.start()
+
+
+@app.on_event('shutdown')
+async def stop_open_orders():
+    await open_orders.stop()
@@ -0,0 +1,170 @@
+from datetime import datetime
+from tortoise import Tortoise, run_async, timezone
+from tortoise.query_utils import Q
+
+from database import TORTOISE_ORM
+from models.shards import shards, create_order_tables
+from models.courier_types import CourierTypes
+from audit import audit_assigned_weight
+from models.order import OrderDB, OrderArchiveDB
+from helpers.time_translate import hours_to_bitmap, bitmap_to_buckets, bitmap_to_bytes
+
+
+async def add_order_columns():
+    """
+    Добавляет в таблицы заказов колонки, появившиеся после их создания
+    :return: None
+    """
+    for db in shards():
+        db = db or Tortoise.get_connection('default')
+        for column, definition in (('completed_at', 'TIMESTAMP'), ('created_at', 'TIMESTAMP'),
+                                   ('delivery_buckets', 'BIGINT NOT NULL DEFAULT 0'), ('updated_at', 'TIMESTAMP')):
+            try:
+                await db.execute_script(f'ALTER TABLE "orderdb" ADD COLUMN "{column}" {definition}')
+            except Exception:
+                # колонка уже есть или таблицы ещё нет
+                pass
+        await add_bitmap_column(db, 'orderdb')
+    for column, definition in (('delivery_buckets', 'BIGINT NOT NULL DEFAULT 0'), ('updated_at', 'TIMESTAMP')):
+        try:
+            await Tortoise.get_connection('default').execute_script(
+                f'ALTER TABLE "orderarchivedb" ADD COLUMN "{column}" {definition}'
+            )
+        except Exception:
+            # колонка уже есть или таблицы ещё нет (её создаст generate_schemas)
+            pass
+    await add_bitmap_column(Tortoise.get_connection('default'), 'orderarchivedb')
+
+
+async def add_bitmap_column(db, table: str):
+    """
+    Добавляет в таблицу заказов колонку точной маски минут доставки (тип двоичных данных у СУБД разный)
+    :param db: подключение
+    :param table: имя таблицы
+    :return: None
+    """
+    for definition in ('BLOB', 'BYTEA'):
+        try:
+            await db.execute_script(f'ALTER TABLE "{table}" ADD COLUMN "delivery_bitmap" {definition}')
+            return
+        except Exception:
+            # колонка уже есть, таблицы ещё нет или синтаксис другой СУБД
+            pass
+
+
+async def add_courier_type_columns():
+    """
+    Добавляет в таблицу типов курьеров параметры подбора заказов (значения по умолчанию сохраняют прежний подбор)
+    :return: None
+    """
+    for column in ('"min_overlap" INT NOT NULL DEFAULT 1', '"max_orders" INT NOT NULL DEFAULT 0'):
+        try:
+            await Tortoise.get_connection('default').execute_script(f'ALTER TABLE "couriertypedb" ADD COLUMN {column}')
+        except Exception:
+            # колонка уже есть или таблицы ещё нет
+            pass
+
+
+async def fill_completed_at():
+    """
+    Проставляет время выполнения заказам, выполненным до появления колонки completed_at (настоящее время
+    неизвестно, берётся время миграции), иначе архив (archive.py) никогда их не перенесёт
+    :return: None
+    """
+    now = datetime.utcnow()
+    for db in shards():
+        await OrderDB.filter(completed=True, completed_at__isnull=True).using_db(db).update(completed_at=now)
+
+
+async def fill_updated_at():
+    """
+    Проставляет время изменения заказам, созданным до появления колонки updated_at: время миграции,
+    чтобы следующая инкрементальная выгрузка один раз отдала их все и ничего не пропустила
+    :return: None
+    """
+    now = timezone.now()
+    for db in shards():
+        await OrderDB.filter(updated_at__isnull=True).using_db(db).update(updated_at=now)
+    await OrderArchiveDB.filter(updated_at__isnull=True).update(updated_at=now)
+
+
+async def fill_delivery_masks(batch_size: int = 1000):
+    """
+    Заполняет корзины и точную маску времени доставки у заказов, созданных до их появления (у любого заказа
+    есть хотя бы один интервал доставки, поэтому пустые корзины означают незаполненные)
+    :return: None
+    """
+    for model, connections in ((OrderDB, shards()), (OrderArchiveDB, [None])):
+        for db in connections:
+            while True:
+                orders = await model.filter(Q(delivery_buckets=0) | Q(delivery_bitmap__isnull=True)) \
+                    .using_db(db).limit(batch_size)
+                if not orders:
+                    break
+                for order in orders:
+                    bitmap = hours_to_bitmap(order.delivery_hours.split(','))
+                    order.delivery_buckets = bitmap_to_buckets(bitmap)
+                    order.delivery_bitmap = bitmap_to_bytes(bitmap)
+                    # bulk_update подставляет значения в текст запроса и не умеет двоичные данные, а save
+                    # передаёт их параметрами
+                    await order.save(update_fields=['delivery_buckets', 'delivery_bitmap'], using_db=db)
+
+
+async def widen_courier_type():
+    """
+    Расширяет колонку типа курьера, чтобы в неё помещались новые типы (sqlite длину не проверяет)
+    :return: None
+    """
+    db = Tortoise.get_connection('default')
+    for statement in ('ALTER TABLE "courierdb" ALTER COLUMN "courier_type" TYPE VARCHAR(16)',
+                      'ALTER TABLE `courierdb` MODIFY `courier_type` VARCHAR(16) NOT NULL'):
+        try:
+            await db.execute_script(statement)
+            return
+        except Exception:
+            # синтаксис другой СУБД
+            pass
+
+
+async def add_assigned_weight() -> bool:
+    """
+    Добавляет курьерам колонку веса назначенных заказов
+    :return: True - колонка добавлена, и её нужно заполнить (audit_assigned_weight)
+    """
+    try:
+        await Tortoise.get_connection('default').execute_script(
+            'ALTER TABLE "courierdb" ADD COLUMN "assigned_weight" REAL NOT NULL DEFAULT 0'
+        )
+    except Exception:
+        # колонка уже есть или таблицы ещё нет
+        return False
+    return True
+
+
+async def migrate():
+    """
+    Добавляет в существующие таблицы недостающие колонки, затем создаёт недостающие таблицы и индексы.
+    Запускается один раз перед стартом воркеров (см. prestart.sh), а не при каждом запуске приложения.
+    Реплика получает схему через репликацию
+    :return: None
+    """
+    await Tortoise.init(config=TORTOISE_ORM)
+    # generate_schemas(safe=True) создаёт индексы и для уже существующих таблиц, поэтому колонки добавляются
+    # раньше: индекс по ещё не добавленной колонке sqlite строит по строковой константе (и после ALTER TABLE
+    # он расходится с таблицей), а postgres прерывает миграцию
+    await add_order_columns()
+    weight_added = await add_assigned_weight()
+    await add_courier_type_columns()
+    await Tortoise.generate_schemas(safe=True)
+    await create_order_tables()
+    await fill_completed_at()
+    await fill_updated_at()
+    await fill_delivery_masks()
+    await widen_courier_type()
+    if weight_added:
+        await audit_assigned_weight(repair=True)
+    await CourierTypes.seed()
+
+
+if __name__ == '__main__':
+    run_async(migrate())
@@ -1,19 +1,40 @@
 from pydantic import BaseModel, validator
 import re
-from typing import List, Optional, Union
+import functools
+from typing import Dict, Iterable, List, Optional, Union
 from tortoise.models import Model
-from tortoise import fields
+from tortoise import fields, timezone
 from tortoise.query_utils import Q
+from tortoise.functions import Count, Sum
+from tortoise.backends.base.client import BaseDBAsyncClient
 from datetime import datetime
 
 
-from models.order import Order, OrderDB
-from helpers.time_translate import time_to_int_intervals
+from database import ORDER_SHARDS
+from models.order import OrderDB, OrderArchiveDB, OrderRecord
+from models.open_orders import open_orders
+from models.feed import feed
+from models.replica import mark_written
+from models.shards import shard, fan_out
+from models.group_commit import group_commit
+from helpers.tracing import traced
+from models.courier_types import courier_types
+from helpers.time_translate import hours_to_bitmap, bitmap_to_buckets
+
+
+def rating(average_times: Iterable[float]) -> float:
+    """
+    Высчитывает рейтинг по средним временам выполнения заказов в районах
+    :param average_times: среднее время выполнения заказа (в секундах) в каждом районе
+    :return: рейтинг float (:.2f)
+    """
+    # рейтинг с округлением до двух знаков после запятой
+    return round((3600 - min(min(average_times), 3600))/3600 * 5, 2)
 
 
 class Courier(BaseModel):
     courier_id: int                                   # айди курьера - 1
-    courier_type: str                                 # тип курьера - 'foot', 'bike' или 'car'
+    courier_type: str                                 # тип курьера - 'foot', 'bike', 'car' (см. courier_types)
     regions: List[int]                                # районы - [1, 2, 3]
     working_hours: List[str]                          # время работы - ["12:00-14:00", "15:30-17:30"]
     assign_time: Optional[Union[datetime, None]]      # время назначения заказов - datetime
@@ -21,6 +42,7 @@ class Courier(BaseModel):
     completed: Optional[Union[List[int], None]]       # id выполненных заказов - [1, 2, 3]
     last_completed: Optional[Union[datetime, None]]   # время выполнения последнего заказа - datetime
     earnings: Optional[int]                           # заработок - 10000
+    assigned_weight: Optional[float] = 0              # суммарный вес назначенных заказов - 12.5
 
     @validator('working_hours')
     def working_hours_validator(cls, v: list):
@@ -36,8 +58,8 @@ class Courier(BaseModel):
 
     @validator('courier_type')
     def type_validator(cls, v: str):
-        if v not in ('foot', 'bike', 'car'):
-            raise ValueError('Courier type must be "foot", "bike" or "car"')
+        if v not in courier_types:
+            raise ValueError(f'Courier type must be one of: {", ".join(courier_types.names())}')
         return v
 
     @validator('regions')
@@ -46,28 +68,28 @@ class Courier(BaseModel):
             raise ValueError('List of regions cannot be empty')
         return v
 
-    async def can_deliver(self, order_interval: List[int], weight: float) -> bool:
+    @traced
+    def match(self, orders: List[OrderRecord]) -> List[OrderRecord]:
         """
-        Проверяет, может ли курьер доставить заказ (проверка по весу и диапазону времени)
-        :param weight: Вес посылки
-        :param order_interval: Диапазон времени для доставки в формате [с (int), до (int)], int - минуты
-        :return: bool
+        Отбирает из переданных заказов те, которые курьер может доставить, без обращений к БД.
+        Заказы проверяются по порядку
+        :param orders: заказы, которые нужно проверить
+        :return: заказы, которые остаются за курьером
         """
+        courier_type = courier_types[self.courier_type]
+        working_hours = hours_to_bitmap(self.working_hours)
         orders_weight = 0
-        for assign in self.assigns:
-            order = await Order.get(assign)
-            orders_weight += order.weight
-        max_weight = {'car': 50, 'bike': 12, 'foot': 10}[self.courier_type]
-        if orders_weight + weight <= max_weight:
-            # если подходит по весу, то проверяем наличие пересечения временных интервалов доставки и работы
-            for interval in time_to_int_intervals(self.working_hours):
-                if (interval[0] <= order_interval[0] <= interval[1]
-                        or interval[0] <= order_interval[1] <= interval[1]
-                        or order_interval[0] <= interval[0] <= order_interval[1]
-                        or order_interval[0] <= interval[1] <= order_interval[1]):
-                    return True
-        return False
+        matched = []
+        for order in orders:
+            if courier_type.full(len(matched)):
+                break
+            if orders_weight + order.weight <= courier_type.max_weight and \
+                    courier_type.overlaps(order.bitmap(), working_hours):
+                matched.append(order)
+                orders_weight += order.weight
+        return matched
 
+    @traced
     async def create(self):
         """
         Сохраняет созданную модель в БД
@@ -83,29 +105,37 @@ class Courier(BaseModel):
                 working_hours=','.join(self.working_hours)
             )
 
+    @traced
     async def save(self):
         """
-        Обновляет изменённую модель в БД.
-        :return: ValueError при неудачной валидации
+        Обновляет изменённую модель в БД. Модель не валидируется повторно,
+        изменённые из API данные нужно проверять до сохранения
+        :return: None
         """
         courier_db = await CourierDB.get(courier_id=self.courier_id)
-        updated_courier = Courier(**self.dict())
-        await courier_db.update(data=updated_courier.dict())
+        await courier_db.update(data=self.dict())
+        mark_written(self.courier_id)
 
     @staticmethod
-    async def get(id: int) -> 'Courier':
+    @traced
+    async def get(id: int, using_db: Optional[BaseDBAsyncClient] = None, for_update: bool = False) -> 'Courier':
         """
         Получает модель из БД и возвращает её репрезентацию
         :param id: id курьера
+        :param using_db: подключение для чтения (None - основная БД)
+        :param for_update: заблокировать строку курьера до конца текущей транзакции (перед её изменением)
         :return: репрезентация типа Courier
         """
-        if await CourierDB.exists(courier_id=id):
-            courier = await CourierDB.get(courier_id=id)
-            return Courier(**courier.dump())
-        else:
+        query = CourierDB.filter(courier_id=id)
+        if for_update:
+            query = query.select_for_update()
+        courier = await query.using_db(using_db).first()
+        if courier is None:
             raise ValueError('Courier with this id does not exist')
+        return Courier(**courier.dump())
 
     @staticmethod
+    @traced
     async def exists(id: int) -> bool:
         """
         Проверяет сущестовавние заказа с указанным id
@@ -113,48 +143,99 @@ class Courier(BaseModel):
         """
         return await CourierDB.exists(courier_id=id)
 
+    @traced
     async def find_and_assign_orders(self):
         """
         Находит и назначает подходящие по времени и весу заказы курьеру
         :return: None
         """
-        max_weight = {'car': 50, 'bike': 12, 'foot': 10}[self.courier_type]
+        max_weight = courier_types[self.courier_type].max_weight
+        # вес назначенных заказов хранится у курьера, дальше он меняется по мере назначения
+        orders_weight = self.assigned_weight
         # Сортировка подходящих заказов по
         # 1) регионам, совпадающими с теми, в которых работает курьер
-        # 2) весу, который должен быть меньше максимально допустимого для типа определённого курьера
+        # 2) весу, который должен помещаться в оставшуюся грузоподъёмность курьера
         # 3) айди курьера, который должен отсутствовать
         # 4) статусу. Заказ не должен быть выполнен
-        orders = await OrderDB.filter(
-            Q(region__in=self.regions) &
-            Q(weight__lte=max_weight) &
-            Q(courier_id__isnull=True) &
-            Q(completed=False)
-        )
-        # Подбираем заказы, у которых время доставки пересекается с временем работы курьера
-        # и которые подойдут по весу с учётом уже присвоенных заказов
-        for order in orders:
-            for interval in time_to_int_intervals(order.delivery_hours):
-                if await self.can_deliver(order_interval=interval, weight=order.weight):
+        # 5) времени доставки: в SQL грубо, по получасовым корзинам, затем точно - по маскам минут
+        working_hours = hours_to_bitmap(self.working_hours)
+        candidates = await open_orders.candidates(self.regions, max_weight - orders_weight)
+        if candidates is None:
+            # запрос выполняется параллельно только в тех шардах, где хранятся заказы районов курьера
+            orders = await OrderRecord.fetch(
+                Q(region__in=self.regions) &
+                Q(weight__lte=max_weight - orders_weight) &
+                Q(courier_id__isnull=True) &
+                Q(completed=False),
+                regions=self.regions,
+                buckets=bitmap_to_buckets(working_hours)
+            )
+            candidates = sorted(
+                ((order.weight, order.order_id, order.bitmap(), order.region) for order in orders),
+                key=lambda x: x[1]
+            )
+
+        async def assign():
+            # курьер перечитывается с блокировкой строки в транзакции записи: после выбора кандидатов его могли
+            # изменить выполнение заказа или правка профиля (в том числе операции той же пачки или одновременные
+            # транзакции), и сохранение не должно их затереть
+            for name, value in await Courier.get(self.courier_id, for_update=True):
+                setattr(self, name, value)
+            courier_type = courier_types[self.courier_type]
+            hours = hours_to_bitmap(self.working_hours)
+            # Подбираем заказы, у которых время доставки пересекается с временем работы курьера
+            # и которые подойдут по весу с учётом уже присвоенных заказов
+            weight_sum = self.assigned_weight
+            for weight, order_id, bitmap, region in candidates:
+                if courier_type.full(len(self.assigns)):
+                    break
+                if region not in self.regions or weight_sum + weight > courier_type.max_weight or \
+                        not courier_type.overlaps(bitmap, hours):
+                    continue
+                # заказ назначается только если он всё ещё свободен (снимок заказов мог устареть)
+                db = shard(region)
+                if await OrderDB.filter(order_id=order_id, courier_id__isnull=True, completed=False) \
+                        .using_db(db).update(courier_id=self.courier_id, updated_at=timezone.now()):
+                    if db is not None:
+                        # запись в шард фиксируется сразу: если курьер не будет сохранён, заказ освобождается
+                        group_commit.on_rollback(functools.partial(self.release, order_id, db))
                     if not self.assigns:
                         self.assign_time = datetime.utcnow()
-                    self.assigns.append(order.order_id)
-                    order.courier_id = self.courier_id
-                    await order.save()
-                    # не имеет смысла проверять последующие интервалы доставки, поэтому выходим из цикла для проверки
-                    # следующего заказа
-                    break
-        await self.save()
+                    self.assigns.append(order_id)
+                    weight_sum += weight
+                open_orders.discard(order_id)
+            self.assigned_weight = weight_sum
+            await self.save()
 
-    async def get_rating(self) -> float:
+        # кандидаты выбираются вне транзакции, записи назначения попадают в пачку групповой фиксации
+        await group_commit.run(assign)
+
+    async def release(self, order_id: int, db: BaseDBAsyncClient):
+        """
+        Освобождает заказ, назначение которого курьеру не сохранилось (отмена записи в шард)
+        :param order_id: id заказа
+        :param db: шард заказа
+        :return: None
+        """
+        await OrderDB.filter(order_id=order_id, courier_id=self.courier_id, completed=False).using_db(db) \
+            .update(courier_id=None, updated_at=timezone.now())
+
+    @traced
+    async def get_rating(self, using_db: Optional[BaseDBAsyncClient] = None) -> Optional[float]:
         """
         Высчитывает и возвращает рейтинг курьера
-        :return: рейтинг float (:.2f)
+        :param using_db: подключение для чтения (None - основная БД)
+        :return: рейтинг float (:.2f) или None, если у курьера нет выполненных заказов
         """
         # создаём словарь, где каждому району соответствует массив с временем выполнения каждого заказа
         # в этом районе
         regions_and_time = dict()
-        for order in self.completed:
-            o = await Order.get(order)
+        orders = await OrderRecord.fetch(order_id__in=self.completed, using_db=using_db) if self.completed else []
+        if len(orders) < len(self.completed):
+            # часть выполненных заказов уже перенесена в архив
+            found = {o.order_id for o in orders}
+            orders += await OrderRecord.fetch_archived(order_id__in=[i for i in self.completed if i not in found])
+        for o in orders:
             if o.region not in regions_and_time.keys():
                 regions_and_time.update({o.region: [o.complete_time]})
             else:
@@ -162,34 +243,65 @@ class Courier(BaseModel):
         # высчитываем среднее время доставки заказа в каждом районе
         for time in regions_and_time.keys():
             regions_and_time[time] = sum(regions_and_time[time])/len(regions_and_time[time])
-        # высчитываем и возвращаем рейтинг с округлением до двух знаков после запятой
-        return round((3600 - min(min(regions_and_time.values()), 3600))/3600 * 5, 2)
+        if not regions_and_time:
+            return None
+        return rating(regions_and_time.values())
+
+    @staticmethod
+    @traced
+    async def get_ratings(ids: List[int], using_db: Optional[BaseDBAsyncClient] = None) -> Dict[int, float]:
+        """
+        Высчитывает рейтинги нескольких курьеров: средние времена выполнения по районам считаются в БД
+        одним сгруппированным запросом (на каждый шард и на архив), без загрузки самих заказов
+        :param ids: id курьеров
+        :param using_db: подключение для чтения (None - основная БД)
+        :return: {courier_id: рейтинг} (курьеров без выполненных заказов в словаре нет)
+        """
+        def grouped(model):
+            return model.filter(courier_id__in=ids, completed=True) \
+                .annotate(total=Sum('complete_time'), count=Count('order_id')).group_by('courier_id', 'region')
 
+        columns = ('courier_id', 'region', 'total', 'count')
+        if ORDER_SHARDS:
+            rows = await fan_out(lambda db: grouped(OrderDB).using_db(db).values_list(*columns))
+        else:
+            rows = list(await grouped(OrderDB).using_db(using_db).values_list(*columns))
+        rows += await grouped(OrderArchiveDB).values_list(*columns)
+        # район курьера может встретиться в нескольких шардах и в архиве - суммы и количества складываются
+        totals = dict()
+        for courier_id, region, total, count in rows:
+            values = totals.setdefault((courier_id, region), [0, 0])
+            values[0] += total
+            values[1] += count
+        averages = dict()
+        for (courier_id, region), (total, count) in totals.items():
+            averages.setdefault(courier_id, []).append(total / count)
+        return {courier_id: rating(values) for courier_id, values in averages.items()}
+
+    @traced
     async def check(self):
         """
         Проверяет уже назначенные заказы на возможность доставки (используется при обновлении типа/регионов/времени)
         :return: None
         """
-        assigns = list()
-        for order in self.assigns:
-            o = await Order.get(id=order)
-            o.courier_id = None
-            await o.save()
-            assigns.append(o)
-        self.assigns = []
-        for assign in assigns:
-            for interval in time_to_int_intervals(assign.delivery_hours):
-                if await self.can_deliver(interval, assign.weight):
-                    self.assigns.append(assign.order_id)
-                    assign.courier_id = self.courier_id
-                    await assign.save()
-                    break
+        # все назначенные заказы загружаются одним запросом и проверяются в том порядке, в котором были назначены
+        orders = {o.order_id: o for o in await OrderRecord.fetch(order_id__in=self.assigns)} if self.assigns else {}
+        kept = {o.order_id for o in self.match([orders[i] for i in self.assigns if i in orders])}
+        released = [orders[i] for i in self.assigns if i in orders and i not in kept]
+        self.assigns = [i for i in self.assigns if i in kept]
+        # вес пересчитывается по заказам из БД, заодно исправляя возможное расхождение
+        self.assigned_weight = sum(orders[i].weight for i in self.assigns)
+        if released:
+            await OrderRecord.update(released, courier_id=None)
+            for o in released:
+                open_orders.add(o.order_id, o.weight, o.region, o.delivery_hours.split(','))
+                feed.publish(o.order_id, o.weight, o.region, o.delivery_hours.split(','))
         await self.save()
 
 
 class CourierDB(Model):
     courier_id = fields.IntField(pk=True)
-    courier_type = fields.CharField(max_length=4)
+    courier_type = fields.CharField(max_length=16)
     regions = fields.TextField()
     working_hours = fields.TextField()
     assign_time = fields.DatetimeField(default=None, null=True)
@@ -197,6 +309,7 @@ class CourierDB(Model):
     completed = fields.TextField(default='', null=True)
     last_completed = fields.DatetimeField(default=None, null=True)
     earnings = fields.IntField(default=0)
+    assigned_weight = fields.FloatField(default=0)
 
     def dump(self) -> dict:
         """
@@ -212,7 +325,8 @@ class CourierDB(Model):
             'assigns': [*map(int, self.assigns.split(','))] if self.assigns != '' else [],
             'completed': [*map(int, self.completed.split(','))] if self.completed != '' else [],
             'last_completed': self.last_completed,
-            'earnings': self.earnings
+            'earnings': self.earnings,
+            'assigned_weight': self.assigned_weight
         }
 
     async def update(self, data: dict):
@@ -0,0 +1,107 @@
+from typing import Dict, Iterable, List
+from tortoise.models import Model
+from tortoise import fields
+
+# Оплата за заказ: BASE_PAY * коэффициент типа курьера
+BASE_PAY = 500
+
+
+class CourierType:
+    """
+    Параметры типа курьера: грузоподъёмность (максимальный суммарный вес назначенных заказов), коэффициент оплаты
+    и параметры подбора заказов: сколько минут интервал доставки должен пересекаться с часами работы
+    и сколько заказов курьер может держать одновременно (0 - без ограничения)
+    """
+    __slots__ = ('name', 'max_weight', 'pay_rate', 'min_overlap', 'max_orders')
+
+    def __init__(self, name: str, max_weight: float, pay_rate: int, min_overlap: int = 1, max_orders: int = 0):
+        self.name = name
+        self.max_weight = max_weight
+        self.pay_rate = pay_rate
+        self.min_overlap = min_overlap
+        self.max_orders = max_orders
+
+    @property
+    def pay(self) -> int:
+        return BASE_PAY * self.pay_rate
+
+    def overlaps(self, order_bitmap: int, working_hours: int) -> bool:
+        """
+        Проверяет, что время доставки заказа пересекается с часами работы не меньше чем на min_overlap минут
+        :param order_bitmap: маска минут доставки заказа (см. hours_to_bitmap)
+        :param working_hours: маска минут работы курьера
+        :return: bool
+        """
+        common = order_bitmap & working_hours
+        if self.min_overlap <= 1:
+            return common != 0
+        return bin(common).count('1') >= self.min_overlap
+
+    def full(self, orders: int) -> bool:
+        """
+        Проверяет, достиг ли курьер предела одновременно назначенных заказов
+        :param orders: сколько заказов уже назначено
+        :return: bool
+        """
+        return 0 < self.max_orders <= orders
+
+
+# типы курьеров по умолчанию: они действуют, пока таблица типов пуста, и ими она заполняется при миграции
+DEFAULT_COURIER_TYPES = (
+    CourierType('foot', 10, 2),
+    CourierType('bike', 12, 5),
+    CourierType('car', 50, 9),
+)
+
+
+class CourierTypeDB(Model):
+    name = fields.CharField(max_length=16, pk=True)
+    max_weight = fields.FloatField()
+    pay_rate = fields.IntField()
+    min_overlap = fields.IntField(default=1)
+    max_orders = fields.IntField(default=0)
+
+
+class CourierTypes:
+    """
+    Реестр типов курьеров. Загружается из БД один раз при старте, после чего типы берутся из памяти.
+    Новый тип добавляется строкой в таблицу couriertypedb и начинает действовать после перезапуска воркеров
+    """
+
+    def __init__(self, types: Iterable[CourierType]):
+        self.types: Dict[str, CourierType] = {t.name: t for t in types}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.types
+
+    def __getitem__(self, name: str) -> CourierType:
+        return self.types[name]
+
+    def names(self) -> List[str]:
+        return list(self.types)
+
+    async def load(self):
+        """
+        Загружает типы из БД (если таблица пуста, остаются типы по умолчанию)
+        :return: None
+        """
+        rows = await CourierTypeDB.all()
+        if rows:
+            self.types = {row.name: CourierType(row.name, row.max_weight, row.pay_rate, row.min_overlap, row.max_orders)
+                          for row in rows}
+
+    @staticmethod
+    async def seed():
+        """
+        Заполняет пустую таблицу типами по умолчанию
+        :return: None
+        """
+        if not await CourierTypeDB.exists():
+            await CourierTypeDB.bulk_create([
+                CourierTypeDB(name=t.name, max_weight=t.max_weight, pay_rate=t.pay_rate, min_overlap=t.min_overlap,
+                              max_orders=t.max_orders)
+                for t in DEFAULT_COURIER_TYPES
+            ])
+
+
+courier_types = CourierTypes(DEFAULT_COURIER_TYPES)
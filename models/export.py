@@ -0,0 +1,121 @@
+import os
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Optional
+from tortoise.query_utils import Q
+
+from models.courier import CourierDB
+from models.order import OrderDB, OrderArchiveDB
+from models.shards import fan_out
+
+# Сколько строк читается из БД за один запрос при выгрузке (столько же строк в одном куске CSV)
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+ORDER_COLUMNS = ('order_id', 'weight', 'region', 'delivery_hours', 'courier_id', 'completed', 'complete_time',
+                 'completed_at', 'created_at', 'updated_at')
+COURIER_COLUMNS = ('courier_id', 'courier_type', 'regions', 'working_hours', 'assign_time', 'assigns', 'completed',
+                   'last_completed', 'earnings', 'assigned_weight')
+
+
+def decode_list(value: Optional[str], item=str) -> str:
+    """
+    Переводит список, который хранится в БД строкой через запятую, в JSON-массив
+    :param value: значение колонки
+    :param item: тип элементов списка
+    :return: JSON-массив строкой
+    """
+    return json.dumps([*map(item, value.split(','))] if value else [])
+
+
+def order_row(row: tuple) -> tuple:
+    """
+    Раскладывает строку заказа из БД в строку выгрузки
+    :return: tuple
+    """
+    order_id, weight, region, delivery_hours, *rest = row
+    return (order_id, weight, region, decode_list(delivery_hours), *rest)
+
+
+def courier_row(row: tuple) -> tuple:
+    """
+    Раскладывает строку курьера из БД в строку выгрузки
+    :return: tuple
+    """
+    courier_id, courier_type, regions, working_hours, assign_time, assigns, completed, *rest = row
+    return (courier_id, courier_type, decode_list(regions, int), decode_list(working_hours), assign_time,
+            decode_list(assigns, int), decode_list(completed, int), *rest)
+
+
+async def order_rows(since: Optional[datetime] = None) -> AsyncIterator[List[tuple]]:
+    """
+    Постранично (по ключу order_id) читает заказы из всех шардов и архива
+    :param since: водяной знак - выгружаются только заказы, изменённые после него по часам сервера (None - все)
+    :return: асинхронный генератор списков строк
+    """
+    after = None
+    while True:
+        # completed_at задаёт клиент (выполнение, синхронизированное позже, несёт старое время), поэтому
+        # изменения отбираются по updated_at, которое ставит сервер при любой записи заказа
+        query = Q(updated_at__gt=since) if since is not None else Q()
+        if after is not None:
+            query &= Q(order_id__gt=after)
+        # каждый шард и архив отдают свои первые EXPORT_CHUNK_SIZE заказов, из объединения берутся первые
+        rows = await fan_out(
+            lambda db: OrderDB.filter(query).using_db(db).order_by('order_id').limit(EXPORT_CHUNK_SIZE)
+            .values_list(*ORDER_COLUMNS)
+        )
+        rows += await OrderArchiveDB.filter(query).order_by('order_id').limit(EXPORT_CHUNK_SIZE) \
+            .values_list(*ORDER_COLUMNS)
+        rows = sorted(rows, key=lambda row: row[0])[:EXPORT_CHUNK_SIZE]
+        if rows:
+            yield [order_row(row) for row in rows]
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            break
+        after = rows[-1][0]
+
+
+async def courier_rows() -> AsyncIterator[List[tuple]]:
+    """
+    Постранично (по ключу courier_id) читает всех курьеров
+    :return: асинхронный генератор списков строк
+    """
+    after = None
+    while True:
+        query = CourierDB.all() if after is None else CourierDB.filter(courier_id__gt=after)
+        rows = await query.order_by('courier_id').limit(EXPORT_CHUNK_SIZE).values_list(*COURIER_COLUMNS)
+        if rows:
+            yield [courier_row(row) for row in rows]
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            break
+        after = rows[-1][0]
+
+
+def render_csv(rows: Iterable[tuple]) -> str:
+    """
+    Переводит строки в CSV
+    :return: str
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(
+        [[value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows]
+    )
+    return buffer.getvalue()
+
+
+async def export_csv(table: str, since: Optional[datetime] = None) -> AsyncIterator[str]:
+    """
+    Выгружает таблицу в CSV по частям: в памяти держится не больше EXPORT_CHUNK_SIZE строк
+    :param table: 'orders' или 'couriers'
+    :param since: водяной знак для заказов (курьеры выгружаются только целиком)
+    :return: асинхронный генератор кусков CSV, первый - заголовок
+    """
+    if table == 'orders':
+        yield render_csv([ORDER_COLUMNS])
+        chunks = order_rows(since)
+    else:
+        yield render_csv([COURIER_COLUMNS])
+        chunks = courier_rows()
+    async for rows in chunks:
+        yield render_csv(rows)
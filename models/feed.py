@@ -0,0 +1,81 @@
+import os
+import asyncio
+from collections import deque
+from typing import Dict, List, Set
+
+from helpers.time_translate import hours_to_bitmap
+
+# Сколько непрочитанных событий хранится для одного подключения (старые вытесняются)
+FEED_BUFFER = int(os.getenv('FEED_BUFFER', 100))
+
+
+class Subscription:
+    """
+    Подписка курьера на новые свободные заказы. Параметры курьера берутся на момент подключения
+    """
+    __slots__ = ('courier_id', 'regions', 'max_weight', 'working_hours', 'events', 'ready')
+
+    def __init__(self, courier_id: int, regions: List[int], max_weight: float, working_hours: int):
+        self.courier_id = courier_id
+        self.regions = regions
+        self.max_weight = max_weight
+        self.working_hours = working_hours          # маска минут работы (см. hours_to_bitmap)
+        self.events = deque(maxlen=FEED_BUFFER)     # id заказов, о которых курьер ещё не узнал
+        self.ready = asyncio.Event()                # выставляется, когда в events появляются заказы
+
+
+class AssignmentsFeed:
+    """
+    Pub/sub в памяти процесса: сообщает подключённым курьерам о свободных заказах в их районах,
+    которые подходят им по весу и времени работы. Без подписчиков публикация ничего не стоит
+    """
+
+    def __init__(self):
+        self.regions: Dict[int, Set[Subscription]] = dict()
+
+    def subscribe(self, courier_id: int, regions: List[int], max_weight: float,
+                  working_hours: List[str]) -> Subscription:
+        """
+        Подписывает курьера на заказы в его районах
+        :return: подписка
+        """
+        subscription = Subscription(courier_id, regions, max_weight, hours_to_bitmap(working_hours))
+        for region in regions:
+            self.regions.setdefault(region, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Отменяет подписку (курьер отключился)
+        :return: None
+        """
+        for region in subscription.regions:
+            subscriptions = self.regions.get(region)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.regions[region]
+
+    def publish(self, order_id: int, weight: float, region: int, delivery_hours: List[str]):
+        """
+        Сообщает подписчикам района о появившемся свободном заказе
+        :return: None
+        """
+        subscriptions = self.regions.get(region)
+        if not subscriptions:
+            return
+        bitmap = hours_to_bitmap(delivery_hours)
+        for subscription in subscriptions:
+            if weight <= subscription.max_weight and bitmap & subscription.working_hours:
+                subscription.events.append(order_id)
+                subscription.ready.set()
+
+    def stats(self) -> dict:
+        """
+        Возвращает количество подключённых курьеров
+        :return: dict
+        """
+        return {'subscriptions': len({s for subscriptions in self.regions.values() for s in subscriptions})}
+
+
+feed = AssignmentsFeed()
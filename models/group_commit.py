@@ -0,0 +1,161 @@
+import os
+import asyncio
+import logging
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from tortoise.transactions import in_transaction, current_transaction_map
+
+logger = logging.getLogger(__name__)
+
+# Отмена записи, сделанной операцией мимо транзакции (например, в шарде заказов)
+Undo = Callable[[], Awaitable]
+# Операция записи, контекст запроса, из которого она пришла, future, через который запрос получает её результат,
+# и отмены её записей мимо транзакции
+Write = Tuple[Callable[[], Awaitable], contextvars.Context, asyncio.Future, List[Undo]]
+
+# отмены текущей операции (None - код выполняется не в group_commit.run)
+undos: contextvars.ContextVar = contextvars.ContextVar('undos', default=None)
+
+
+class GroupCommit:
+    """
+    Групповая фиксация записей: операции записи одновременных запросов копятся window секунд и выполняются
+    одной транзакцией, поэтому на пачку приходится один commit (и один fsync) вместо одного на запрос.
+    Каждая операция выполняется в своей точке сохранения: ошибка откатывает только её изменения.
+    Запрос получает результат операции только после фиксации всей пачки.
+    Записи операции в другие БД (шарды заказов) в транзакцию не входят: операция регистрирует их отмену
+    через on_rollback, и отмена выполняется, если записи операции в connection не зафиксированы
+    """
+
+    def __init__(self, window: float = 0, max_batch: int = 200):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches: Dict[str, List[Write]] = dict()
+        self.timers: Dict[str, asyncio.TimerHandle] = dict()
+        self.committed = 0    # зафиксировано пачек
+        self.writes = 0       # выполнено операций в них
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def run(self, operation: Callable[[], Awaitable], connection: str = 'default') -> Any:
+        """
+        Выполняет операцию записи в составе ближайшей пачки (без групповой фиксации - сразу, в своей транзакции)
+        :param operation: функция, возвращающая корутину. Её запросы к connection выполняются в транзакции пачки,
+        поэтому операция должна сама читать то, что изменяет, чтобы видеть записи предыдущих операций
+        :param connection: имя подключения, транзакция которого объединяет записи
+        :return: результат операции (её исключение пробрасывается в запрос)
+        """
+        if not self.enabled:
+            undo = []
+            token = undos.set(undo)
+            try:
+                # чтение и запись операции не должны перемежаться с записями других запросов
+                async with in_transaction(connection):
+                    return await operation()
+            except BaseException:
+                await self.rollback(undo)
+                raise
+            finally:
+                undos.reset(token)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        batch = self.batches.get(connection)
+        if batch is None:
+            batch = self.batches[connection] = []
+            # сама пачка фиксируется в пустом контексте, а не в контексте первого запроса
+            self.timers[connection] = loop.call_later(self.window, self.flush, connection,
+                                                      context=contextvars.Context())
+        batch.append((operation, contextvars.copy_context(), future, []))
+        if len(batch) >= self.max_batch:
+            contextvars.Context().run(self.flush, connection)
+        return await future
+
+    @staticmethod
+    def on_rollback(undo: Undo):
+        """
+        Регистрирует отмену записи, сделанной текущей операцией мимо её транзакции
+        :param undo: функция, возвращающая корутину отмены (она выполняется вне транзакции операции)
+        :return: None
+        """
+        current = undos.get()
+        if current is not None:
+            current.append(undo)
+
+    @staticmethod
+    async def rollback(undo: List[Undo]):
+        """
+        Выполняет отмены операции в обратном порядке. Ошибка отмены пишется в лог, оставшуюся запись
+        найдёт и исправит audit.py
+        :return: None
+        """
+        while undo:
+            try:
+                await undo.pop()()
+            except Exception:
+                logger.exception('Group commit undo failed')
+
+    def flush(self, connection: str):
+        """
+        Отправляет накопленную пачку на фиксацию
+        :return: None
+        """
+        timer = self.timers.pop(connection, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.batches.pop(connection, None)
+        if batch:
+            asyncio.ensure_future(self.commit(connection, batch))
+
+    async def commit(self, connection: str, batch: List[Write]):
+        """
+        Выполняет операции пачки одной транзакцией и после фиксации отдаёт результаты запросам
+        :return: None
+        """
+        results = []
+        try:
+            async with in_transaction(connection) as db:
+                for operation, context, _, undo in batch:
+                    # операция выполняется в контексте своего запроса (например, его трассы),
+                    # но её запросы к БД идут в транзакцию пачки
+                    context.run(current_transaction_map[connection].set, db)
+                    context.run(undos.set, undo)
+                    await db.execute_query('SAVEPOINT group_commit')
+                    try:
+                        results.append((True, await context.run(asyncio.ensure_future, operation())))
+                    except Exception as e:
+                        await db.execute_query('ROLLBACK TO SAVEPOINT group_commit')
+                        await self.rollback(undo)
+                        results.append((False, e))
+                    await db.execute_query('RELEASE SAVEPOINT group_commit')
+        except BaseException as e:
+            # пачка не зафиксирована - ни одна операция не считается выполненной, их записи мимо транзакции
+            # отменяются. Запросы ждут future, поэтому они завершаются при любой ошибке, в том числе при отмене
+            for _, _, _, undo in batch:
+                await self.rollback(undo)
+            for _, _, future, _ in batch:
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        self.committed += 1
+        self.writes += len(batch)
+        for (_, _, future, _), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+group_commit = GroupCommit(
+    window=float(os.getenv('GROUP_COMMIT_WINDOW', 0)) / 1000,
+    max_batch=int(os.getenv('GROUP_COMMIT_MAX_BATCH', 200))
+)
@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import contextvars
+from bisect import bisect_right, insort
+from typing import Dict, List, Tuple, Optional
+
+from helpers.time_translate import hours_to_bitmap
+
+logger = logging.getLogger(__name__)
+
+# Запись снимка: (вес, id заказа, маска минут доставки, район)
+Entry = Tuple[float, int, int, int]
+
+
+class OpenOrdersSnapshot:
+    """
+    Хранящийся в памяти процесса снимок свободных (не назначенных и не выполненных) заказов.
+    Заказы разложены по районам и отсортированы по весу, часы доставки уже переведены в маски минут.
+    Снимок обновляется хуками в Order.create/save и раз в max_age секунд сверяется с БД фоновой задачей
+    (заказы, созданные и назначенные другими воркерами, хуки этого процесса не видят)
+    """
+
+    def __init__(self, enabled: bool = False, max_age: float = 60, max_size: int = 100000):
+        self.enabled = enabled
+        self.max_age = max_age
+        self.max_size = max_size
+        self.loaded_at: Optional[float] = None
+        self.regions: Dict[int, List[Entry]] = dict()
+        self.index: Dict[int, Entry] = dict()
+        self.reloads = 0                                  # перезагрузок из БД
+        self.loading: Optional[asyncio.Future] = None     # идущая перезагрузка, её ждут все запросы
+        self.task: Optional[asyncio.Task] = None          # фоновая сверка с БД
+
+    async def reload(self):
+        """
+        Перечитывает свободные заказы из БД
+        :return: None
+        """
+        # импорт здесь, так как models.order сам обращается к снимку из хуков
+        from models.order import OrderRecord
+        orders = await OrderRecord.fetch(courier_id__isnull=True, completed=False)
+        if len(orders) > self.max_size:
+            # снимок не помещается в отведённый объём, дальше работаем напрямую с БД
+            logger.warning('Open orders snapshot disabled: %s orders exceed max size %s', len(orders), self.max_size)
+            self.enabled = False
+            self.clear()
+            return
+        self.clear()
+        for order in orders:
+            entry = (order.weight, order.order_id, order.bitmap(), order.region)
+            self.regions.setdefault(order.region, []).append(entry)
+            self.index[order.order_id] = entry
+        for entries in self.regions.values():
+            entries.sort()
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+        logger.info('Open orders snapshot reloaded: %s', self.stats())
+
+    async def refresh(self):
+        """
+        Перечитывает снимок из БД. Одновременные вызовы ждут одну и ту же перезагрузку
+        :return: None
+        """
+        if self.loading is None:
+            # перезагрузка идёт в пустом контексте: она общая и не относится к трассе или транзакции запроса
+            self.loading = contextvars.Context().run(asyncio.ensure_future, self.reload())
+            self.loading.add_done_callback(self.loaded)
+        # отмена ожидающего запроса не прерывает перезагрузку, которую ждут остальные
+        await asyncio.shield(self.loading)
+
+    def loaded(self, _):
+        self.loading = None
+
+    async def reconcile(self):
+        """
+        Фоновая сверка: раз в max_age секунд перечитывает снимок из БД, пока снимок включён
+        :return: None
+        """
+        while self.enabled:
+            await asyncio.sleep(self.max_age)
+            try:
+                await self.refresh()
+            except Exception:
+                # снимок остаётся прежним, его возраст виден в /metrics; следующая попытка - через max_age
+                logger.exception('Open orders snapshot reload failed')
+
+    def start(self):
+        """
+        Запускает фоновую сверку с БД (при старте приложения)
+        :return: None
+        """
+        if self.enabled and self.task is None:
+            self.task = contextvars.Context().run(asyncio.ensure_future, self.reconcile())
+
+    async def stop(self):
+        """
+        Останавливает фоновую сверку (при остановке приложения)
+        :return: None
+        """
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def clear(self):
+        """
+        Очищает снимок, при следующем обращении он будет загружен из БД заново
+        :return: None
+        """
+        self.regions = dict()
+        self.index = dict()
+        self.loaded_at = None
+
+    def add(self, order_id: int, weight: float, region: int, delivery_hours: List[str]):
+        """
+        Добавляет свободный заказ в снимок (или обновляет его)
+        :return: None
+        """
+        # пока снимок не загружен, заказ попадёт в него при первой загрузке
+        if not self.enabled or self.loaded_at is None:
+            return
+        self.discard(order_id)
+        entry = (weight, order_id, hours_to_bitmap(delivery_hours), region)
+        insort(self.regions.setdefault(region, []), entry)
+        self.index[order_id] = entry
+
+    def discard(self, order_id: int):
+        """
+        Убирает заказ из снимка (заказ назначен или выполнен)
+        :return: None
+        """
+        entry = self.index.pop(order_id, None)
+        if entry is not None:
+            self.regions[entry[3]].remove(entry)
+
+    async def candidates(self, regions: List[int], max_weight: float) -> Optional[List[Entry]]:
+        """
+        Возвращает свободные заказы в указанных районах с весом не больше max_weight
+        в порядке возрастания id (как при выборке из БД)
+        :param regions: районы курьера
+        :param max_weight: максимальный вес заказа
+        :return: список записей (вес, id заказа, маска минут, район) или None, если снимок отключён
+        """
+        # без фоновой сверки (скрипты, тесты) устаревший снимок перечитывается здесь
+        if self.enabled and (self.loaded_at is None or
+                             self.task is None and time.monotonic() - self.loaded_at > self.max_age):
+            await self.refresh()
+        if not self.enabled:
+            return None
+        result = []
+        for region in regions:
+            entries = self.regions.get(region, [])
+            result += entries[:bisect_right(entries, (max_weight, float('inf')))]
+        return sorted(result, key=lambda x: x[1])
+
+    def stats(self) -> dict:
+        """
+        Возвращает размер снимка, примерный объём занимаемой памяти (в байтах), возраст (в секундах)
+        и число перезагрузок
+        :return: dict
+        """
+        size = sys.getsizeof(self.index) + sys.getsizeof(self.regions)
+        for entries in self.regions.values():
+            size += sys.getsizeof(entries)
+        for entry in self.index.values():
+            size += sys.getsizeof(entry) + sys.getsizeof(entry[2])
+        return {
+            'enabled': self.enabled,
+            'orders': len(self.index),
+            'memory': size,
+            'age': None if self.loaded_at is None else time.monotonic() - self.loaded_at,
+            'max_age': self.max_age,
+            'reloads': self.reloads
+        }
+
+
+open_orders = OpenOrdersSnapshot(
+    enabled=os.getenv('OPEN_ORDERS_SNAPSHOT', '').lower() in ('1', 'true', 'yes'),
+    max_age=float(os.getenv('OPEN_ORDERS_MAX_AGE', 60)),
+    max_size=int(os.getenv('OPEN_ORDERS_MAX_SIZE', 100000))
+)
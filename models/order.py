@@ -1,8 +1,19 @@
+import asyncio
 from pydantic import BaseModel, validator
 import re
 from typing import List, Optional
+from datetime import datetime
 from tortoise.models import Model
-from tortoise import fields
+from tortoise import fields, timezone
+from tortoise.backends.base.client import BaseDBAsyncClient
+from pypika.terms import Field as PypikaField
+
+from database import ORDER_SHARDS
+from models.open_orders import open_orders
+from models.feed import feed
+from models.shards import shard, fan_out
+from helpers.time_translate import hours_to_bitmap, bitmap_to_buckets, bitmap_to_bytes, bytes_to_bitmap
+from helpers.tracing import traced
 
 
 class Order(BaseModel):
@@ -13,6 +24,7 @@ class Order(BaseModel):
     courier_id: Optional[int]     # айди назначенного курьера - 1
     completed: Optional[bool]     # заказ доставлен - True/False
     complete_time: Optional[int]  # за какое время доставлен (в секундах) - 300
+    completed_at: Optional[datetime]  # когда доставлен - datetime
 
     @validator('delivery_hours')
     def delivery_hours_validator(cls, v: list):
@@ -32,56 +44,88 @@ class Order(BaseModel):
             raise ValueError('Weight must be bigger than 0.01 and less than 50 kilograms')
         return v
 
+    @traced
     async def create(self):
-        if await OrderDB.exists(order_id=self.order_id):
+        if await Order.exists(self.order_id):
             raise ValueError('Order with this id already exists')
         else:
+            bitmap = hours_to_bitmap(self.delivery_hours)
             await OrderDB.create(
-                id=self.order_id,
+                order_id=self.order_id,
                 weight=self.weight,
                 region=self.region,
-                delivery_hours=','.join(self.delivery_hours)
+                delivery_hours=','.join(self.delivery_hours),
+                delivery_buckets=bitmap_to_buckets(bitmap),
+                delivery_bitmap=bitmap_to_bytes(bitmap),
+                using_db=shard(self.region)
             )
+            open_orders.add(self.order_id, self.weight, self.region, self.delivery_hours)
+            feed.publish(self.order_id, self.weight, self.region, self.delivery_hours)
 
     @staticmethod
+    @traced
     async def get(id: int) -> 'Order':
         """
         Получает модель из БД и возвращает её репрезентацию
         :param id: id заказа
         :return: репрезентация типа Order
         """
-        if await OrderDB.exists(order_id=id):
-            order = await OrderDB.get(order_id=id)
-            return Order(**order.dump())
-        else:
+        # район заказа неизвестен, поэтому он ищется во всех шардах, а затем в архиве
+        orders = await fan_out(lambda db: OrderDB.filter(order_id=id).using_db(db)) \
+            or await OrderArchiveDB.filter(order_id=id)
+        if not orders:
             raise ValueError('Order with this id does not exist')
+        return Order(**orders[0].dump())
 
+    @traced
     async def save(self):
         """
         Сохраняет изменённую модель в БД.
         :return: ValueError при неудачной валидации
         """
-        order_db = await OrderDB.get(order_id=self.order_id)
+        db = shard(self.region)
+        order_db = await OrderDB.filter(order_id=self.order_id).using_db(db).get()
         updated_order = Order(**self.dict())
-        await order_db.update(data=updated_order.dict())
+        await order_db.update(data=updated_order.dict(), using_db=db)
+        if self.courier_id is None and not self.completed:
+            open_orders.add(self.order_id, self.weight, self.region, self.delivery_hours)
+            feed.publish(self.order_id, self.weight, self.region, self.delivery_hours)
+        else:
+            open_orders.discard(self.order_id)
 
     @staticmethod
+    @traced
     async def exists(id: int) -> bool:
         """
         Проверяет сущестовавние заказа с указанным id
         :return: True/False
         """
-        return await OrderDB.exists(order_id=id)
+        return bool(await fan_out(
+            lambda db: OrderDB.filter(order_id=id).using_db(db).limit(1).values_list('order_id', flat=True)
+        )) or await OrderArchiveDB.exists(order_id=id)
 
 
-class OrderDB(Model):
+class OrderBase(Model):
     order_id = fields.IntField(pk=True)
     weight = fields.FloatField()
     region = fields.IntField()
     delivery_hours = fields.TextField()
-    courier_id = fields.IntField(null=True, default=None)
+    # корзины по BUCKET_MINUTES минут, в которые заказ можно доставить (см. bitmap_to_buckets)
+    delivery_buckets = fields.BigIntField(default=0)
+    # точная маска минут доставки (см. bitmap_to_bytes), чтобы подбор заказов не разбирал delivery_hours
+    # заново; у заказов, созданных до её появления, пуста, пока её не заполнит migrate.py
+    delivery_bitmap = fields.BinaryField(null=True)
+    courier_id = fields.IntField(null=True, default=None, index=True)
     completed = fields.BooleanField(default=False)
     complete_time = fields.IntField(null=True, default=None)
+    completed_at = fields.DatetimeField(null=True, default=None, index=True)
+    created_at = fields.DatetimeField(null=True, auto_now_add=True, index=True)
+    # время последнего изменения строки по часам сервера (водяной знак выгрузки). save и bulk_update
+    # обновляют его сами, в QuerySet.update его нужно передавать явно
+    updated_at = fields.DatetimeField(null=True, auto_now=True, index=True)
+
+    class Meta:
+        abstract = True
 
     def dump(self):
         """
@@ -95,17 +139,116 @@ class OrderDB(Model):
             'delivery_hours': [*self.delivery_hours.split(',')],
             'courier_id': self.courier_id,
             'completed': self.completed,
-            'complete_time': self.complete_time
+            'complete_time': self.complete_time,
+            'completed_at': self.completed_at
         }
 
-    async def update(self, data: dict):
+
+class OrderDB(OrderBase):
+    async def update(self, data: dict, using_db: Optional[BaseDBAsyncClient] = None):
         """
         Обновляет данные в БД
         :param data: данные для обновления
+        :param using_db: шард, в котором хранится заказ (None - основная БД)
         :return: None
         """
         if 'delivery_hours' in data.keys():
             data['delivery_hours'] = ','.join(data['delivery_hours'])
         await self.update_from_dict(data=data)
-        await self.save()
+        await self.save(using_db=using_db)
+
+
+class OrderArchiveDB(OrderBase):
+    """
+    Архив выполненных заказов (см. archive.py). Выполненные давно заказы переносятся сюда из OrderDB,
+    чтобы таблица заказов, с которой работает назначение, не росла бесконечно. Архив хранится в основной БД
+    """
+
+
+class OrderRecord:
+    """
+    Лёгкое внутреннее представление заказа для циклов в моделях: без pydantic и повторной валидации,
+    данные уже проверены при создании заказа. Не используется в API
+    """
+    __slots__ = ('order_id', 'weight', 'region', 'delivery_hours', 'courier_id', 'completed', 'complete_time',
+                 'delivery_bitmap')
+    # поля OrderDB в том порядке, в котором их принимает конструктор
+    fields = ('order_id', 'weight', 'region', 'delivery_hours', 'courier_id', 'completed', 'complete_time',
+              'delivery_bitmap')
+
+    def __init__(self, order_id: int, weight: float, region: int, delivery_hours: str,
+                 courier_id: Optional[int] = None, completed: bool = False, complete_time: Optional[int] = None,
+                 delivery_bitmap: Optional[bytes] = None):
+        self.order_id = order_id
+        self.weight = weight
+        self.region = region
+        self.delivery_hours = delivery_hours    # строка из БД - "12:00-14:00,15:30-17:30"
+        self.courier_id = courier_id
+        self.completed = completed
+        self.complete_time = complete_time
+        self.delivery_bitmap = delivery_bitmap  # точная маска из БД (None - ещё не заполнена)
+
+    def bitmap(self) -> int:
+        """
+        Возвращает маску минут суток, в которые заказ можно доставить (см. hours_to_bitmap)
+        :return: int
+        """
+        if self.delivery_bitmap is not None:
+            return bytes_to_bitmap(self.delivery_bitmap)
+        return hours_to_bitmap(self.delivery_hours.split(','))
 
+    @staticmethod
+    @traced
+    async def fetch(*args, using_db: Optional[BaseDBAsyncClient] = None, regions: Optional[List[int]] = None,
+                    buckets: Optional[int] = None, **kwargs) -> List['OrderRecord']:
+        """
+        Загружает заказы одним запросом (на каждый шард), минуя создание моделей Tortoise и pydantic
+        :param args: фильтры (Q) для OrderDB.filter
+        :param using_db: подключение, через которое выполняется запрос без шардов (None - основная БД)
+        :param regions: районы, шарды которых нужно опросить (None - все шарды)
+        :param buckets: маска корзин времени, с которой должны пересекаться корзины доставки (None - без фильтра)
+        :param kwargs: фильтры для OrderDB.filter
+        :return: список OrderRecord
+        """
+        query = OrderDB.filter(*args, **kwargs)
+        if buckets is not None:
+            # побитовое И считается в БД: заказы, которые заведомо нельзя доставить в это время, не загружаются
+            query = query.annotate(buckets_overlap=PypikaField('delivery_buckets').bitwiseand(buckets)) \
+                .filter(buckets_overlap__gt=0)
+        if ORDER_SHARDS:
+            rows = await fan_out(lambda db: query.using_db(db).values_list(*OrderRecord.fields), regions)
+        else:
+            rows = await query.using_db(using_db).values_list(*OrderRecord.fields)
+        return [OrderRecord(*row) for row in rows]
+
+    @staticmethod
+    @traced
+    async def fetch_archived(*args, **kwargs) -> List['OrderRecord']:
+        """
+        Загружает заказы из архива одним запросом
+        :param args: фильтры (Q) для OrderArchiveDB.filter
+        :param kwargs: фильтры для OrderArchiveDB.filter
+        :return: список OrderRecord
+        """
+        rows = await OrderArchiveDB.filter(*args, **kwargs).values_list(*OrderRecord.fields)
+        return [OrderRecord(*row) for row in rows]
+
+    @staticmethod
+    @traced
+    async def update(orders: List['OrderRecord'], **values):
+        """
+        Обновляет поля заказов одним запросом на каждый шард
+        :param orders: заказы
+        :param values: новые значения полей
+        :return: None
+        """
+        by_region = dict()
+        for order in orders:
+            by_region.setdefault(order.region, []).append(order.order_id)
+        by_shard = dict()
+        for region, ids in by_region.items():
+            by_shard.setdefault(shard(region), []).extend(ids)
+        await asyncio.gather(*(
+            OrderDB.filter(order_id__in=ids).using_db(db).update(**values, updated_at=timezone.now())
+            for db, ids in by_shard.items()
+        ))
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, TypeVar
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import DBConnectionError, OperationalError
+
+from database import REPLICA_MAX_LAG
+
+T = TypeVar('T')
+
+# время последнего изменения курьеров этим процессом (по возрастанию): courier_id -> time.monotonic()
+written: 'OrderedDict[int, float]' = OrderedDict()
+
+
+def mark_written(*courier_ids: int):
+    """
+    Отмечает, что курьеры только что изменены: ближайшие REPLICA_MAX_LAG секунд они читаются с основной БД,
+    так как реплика могла ещё не получить изменения
+    :param courier_ids: id курьеров
+    :return: None
+    """
+    now = time.monotonic()
+    for courier_id in courier_ids:
+        written[courier_id] = now
+        written.move_to_end(courier_id)
+    # записи старше REPLICA_MAX_LAG больше не нужны
+    while written and now - next(iter(written.values())) > REPLICA_MAX_LAG:
+        written.popitem(last=False)
+
+
+def read_connection(courier_id: int) -> Optional[BaseDBAsyncClient]:
+    """
+    Выбирает подключение для чтения данных курьера
+    :param courier_id: id курьера
+    :return: подключение к реплике или None (основная БД)
+    """
+    if courier_id in written and time.monotonic() - written[courier_id] <= REPLICA_MAX_LAG:
+        return None
+    try:
+        return Tortoise.get_connection('replica')
+    except KeyError:
+        return None
+
+
+async def read_with_fallback(read: Callable[[Optional[BaseDBAsyncClient]], Awaitable[T]],
+                             db: Optional[BaseDBAsyncClient], missing: Callable[[T], bool]) -> T:
+    """
+    Читает данные через подключение db и повторяет чтение с основной БД, если реплика недоступна
+    или ещё не получила данные
+    :param read: чтение через переданное подключение (None - основная БД)
+    :param db: подключение из read_connection (None - сразу основная БД)
+    :param missing: проверяет результат чтения с реплики: True - части данных на ней ещё нет
+    :return: результат read
+    """
+    if db is not None:
+        try:
+            result = await read(db)
+            if not missing(result):
+                return result
+        except (OperationalError, DBConnectionError):
+            pass
+        # реплика недоступна или ещё не получила данные - повторяем чтение с основной БД
+    return await read(None)
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable, List, Optional
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from database import ORDER_SHARDS
+
+# Заказы (OrderDB) могут храниться в нескольких БД - шардах. Шард заказа определяется его районом:
+# region % количество шардов. Без шардов все функции работают с основной БД (подключение None)
+
+
+def shard(region: int) -> Optional[BaseDBAsyncClient]:
+    """
+    Возвращает подключение к шарду, в котором хранятся заказы района
+    :param region: район
+    :return: подключение или None (шардов нет, основная БД)
+    """
+    if not ORDER_SHARDS:
+        return None
+    return Tortoise.get_connection(f'shard{region % len(ORDER_SHARDS)}')
+
+
+def shards(regions: Optional[Iterable[int]] = None) -> List[Optional[BaseDBAsyncClient]]:
+    """
+    Возвращает подключения к шардам, в которых хранятся заказы районов
+    :param regions: районы (None - все шарды)
+    :return: список подключений ([None], если шардов нет)
+    """
+    if not ORDER_SHARDS:
+        return [None]
+    if regions is None:
+        numbers = range(len(ORDER_SHARDS))
+    else:
+        numbers = sorted({region % len(ORDER_SHARDS) for region in regions})
+    return [Tortoise.get_connection(f'shard{i}') for i in numbers]
+
+
+async def fan_out(query: Callable[[Optional[BaseDBAsyncClient]], Awaitable[list]],
+                  regions: Optional[Iterable[int]] = None) -> list:
+    """
+    Параллельно выполняет запрос на всех нужных шардах и объединяет результаты
+    :param query: функция, которая по подключению возвращает корутину со списком результатов
+    :param regions: районы (None - все шарды)
+    :return: объединённый список результатов
+    """
+    connections = shards(regions)
+    if len(connections) == 1:
+        return list(await query(connections[0]))
+    result = []
+    for part in await asyncio.gather(*(query(db) for db in connections)):
+        result += part
+    return result
+
+
+async def create_order_tables():
+    """
+    Создаёт таблицу заказов в каждом шарде (основная БД получает её вместе с остальными схемами)
+    :return: None
+    """
+    from models.order import OrderDB
+    for i in range(len(ORDER_SHARDS)):
+        client = Tortoise.get_connection(f'shard{i}')
+        generator = client.schema_generator(client)
+        await generator.generate_from_string(generator._get_table_sql(OrderDB, safe=True)['table_creation_string'])
@@ -0,0 +1,4 @@
+#! /usr/bin/env bash
+
+# Образ tiangolo/uvicorn-gunicorn-fastapi выполняет этот скрипт один раз перед запуском воркеров gunicorn
+python /app/migrate.py
@@ -0,0 +1,256 @@
+"""
+Воспроизведение записанных запросов (см. RECORD_REQUESTS) против приложения в том же процессе, без сети.
+Для каждого маршрута считаются задержки и число запросов к БД, в конце сохраняется состояние БД,
+которое можно сравнить с состоянием предыдущего прогона.
+Запуск: python replay.py requests.log [--speedup 10] [--concurrency 4] [--state new.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+from starlette.routing import Match
+from tortoise import Tortoise, run_async
+from tortoise.log import db_client_logger
+
+from helpers.recorder import decode_body
+
+# Колонки, которые зависят от времени сервера и поэтому отличаются между прогонами
+IGNORED_COLUMNS = ('assign_time', 'created_at', 'updated_at', 'complete_time', 'completed_at', 'last_completed')
+
+# счётчик запросов к БД текущего воспроизводимого запроса
+queries: contextvars.ContextVar = contextvars.ContextVar('queries', default=None)
+
+
+class QueryCounter(logging.Handler):
+    """
+    Считает запросы к БД по отладочному логу tortoise
+    """
+
+    def emit(self, record: logging.LogRecord):
+        counter = queries.get()
+        if counter is not None and not str(record.msg).startswith(('Created connection', 'Closed connection')):
+            counter[0] += 1
+
+
+def load(path: str) -> List[dict]:
+    """
+    Читает записанные запросы
+    :param path: файл, записанный RecordMiddleware
+    :return: список запросов в порядке поступления
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def shift_times(value, shift):
+    """
+    Переносит complete_time в теле запроса на время воспроизведения, чтобы оно шло после назначения заказа
+    :param value: тело запроса (JSON)
+    :param shift: функция, которая переводит записанное время во время воспроизведения
+    :return: изменённое тело
+    """
+    if isinstance(value, list):
+        return [shift_times(item, shift) for item in value]
+    if isinstance(value, dict):
+        return {key: shift(item) if key == 'complete_time' and isinstance(item, str) else shift_times(item, shift)
+                for key, item in value.items()}
+    return value
+
+
+async def call(app, record: dict) -> int:
+    """
+    Выполняет один запрос через ASGI-интерфейс приложения
+    :return: HTTP-статус ответа
+    """
+    body = decode_body(record)
+    headers = [(k.encode(), v.encode()) for k, v in record['headers'].items()]
+    headers.append((b'content-length', str(len(body)).encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'method': record['method'], 'path': record['path'], 'raw_path': record['path'].encode(),
+        'query_string': record['query'].encode(), 'root_path': '', 'headers': headers,
+        'client': (record['client'], 0), 'server': ('replay', 80)
+    }
+    status = 0
+    done = asyncio.Event()
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # потоковые ответы ждут отключения клиента - оно наступает после получения ответа целиком
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+            done.set()
+
+    await app(scope, receive, send)
+    return status
+
+
+def route_of(routes: list, record: dict) -> str:
+    """
+    Определяет маршрут запроса (путь с параметрами), по которому группируется статистика
+    :return: "МЕТОД путь"
+    """
+    scope = {'type': 'http', 'method': record['method'], 'path': record['path']}
+    for route in routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return f"{record['method']} {route.path}"
+    return f"{record['method']} {record['path']}"
+
+
+async def replay(app, records: List[dict], speedup: float = 0, concurrency: int = 1,
+                 routes: Optional[list] = None) -> Dict[str, dict]:
+    """
+    Воспроизводит запросы. При concurrency=1 запросы выполняются строго по очереди и результат детерминирован
+    :param app: ASGI-приложение
+    :param records: записанные запросы
+    :param speedup: во сколько раз быстрее записи подаются запросы (0 - без пауз)
+    :param concurrency: сколько запросов выполняется одновременно
+    :param routes: маршруты приложения для группировки (по умолчанию app.router.routes)
+    :return: статистика по маршрутам
+    """
+    routes = app.router.routes if routes is None else routes
+    handler = QueryCounter()
+    level = db_client_logger.level
+    db_client_logger.addHandler(handler)
+    db_client_logger.setLevel(logging.DEBUG)
+    stats = dict()
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+    recorded = records[0]['ts'] if records else 0
+    started = time.time()
+    scale = speedup or 1
+
+    def shift(value: str) -> str:
+        moment = datetime.fromisoformat(value)
+        origin = datetime.fromtimestamp(recorded, tz=moment.tzinfo)
+        return (datetime.fromtimestamp(started, tz=moment.tzinfo) + (moment - origin) / scale).isoformat()
+
+    async def run(record: dict):
+        if speedup:
+            await asyncio.sleep(max(0.0, (record['ts'] - recorded) / speedup - (time.time() - started)))
+        async with semaphore:
+            body = record.get('body')
+            if body and record['headers'].get('content-type', '').startswith('application/json'):
+                record = {**record, 'body': json.dumps(shift_times(json.loads(body), shift))}
+            counter = [0]
+            queries.set(counter)
+            start = loop.time()
+            status = await call(app, record)
+            elapsed = loop.time() - start
+        route = stats.setdefault(route_of(routes, record), {'latencies': [], 'queries': 0, 'statuses': Counter()})
+        route['latencies'].append(elapsed)
+        route['queries'] += counter[0]
+        route['statuses'][status] += 1
+
+    # потоковые подписки не заканчиваются сами, их воспроизводить бессмысленно
+    records = [record for record in records if not record['path'].endswith('/stream')]
+    try:
+        if concurrency == 1:
+            for record in records:
+                await asyncio.create_task(run(record))
+        else:
+            await asyncio.gather(*(run(record) for record in records))
+    finally:
+        db_client_logger.removeHandler(handler)
+        db_client_logger.setLevel(level)
+    return stats
+
+
+def report(stats: Dict[str, dict]):
+    """
+    Печатает задержки (p50/p95/max), среднее число запросов к БД и статусы ответов по маршрутам
+    :return: None
+    """
+    for route, values in sorted(stats.items()):
+        latencies = sorted(values['latencies'])
+        count = len(latencies)
+        print(f'{route:45} {count:6} req  p50 {latencies[count // 2] * 1000:7.2f} ms  '
+              f'p95 {latencies[min(count - 1, int(count * 0.95))] * 1000:7.2f} ms  '
+              f'max {latencies[-1] * 1000:7.2f} ms  {values["queries"] / count:5.1f} queries/req  '
+              f'{dict(sorted(values["statuses"].items()))}')
+
+
+async def snapshot() -> dict:
+    """
+    Снимает состояние курьеров и заказов без колонок, зависящих от времени сервера
+    :return: {'couriers': {id: строка}, 'orders': {id: строка}}
+    """
+    from models.export import ORDER_COLUMNS, COURIER_COLUMNS, order_rows, courier_rows
+    state = dict()
+    for table, columns, chunks in (('couriers', COURIER_COLUMNS, courier_rows()),
+                                   ('orders', ORDER_COLUMNS, order_rows())):
+        state[table] = dict()
+        async for rows in chunks:
+            for row in rows:
+                state[table][str(row[0])] = {c: v for c, v in zip(columns, row) if c not in IGNORED_COLUMNS}
+    return state
+
+
+def compare(old: dict, new: dict, examples: int = 5) -> int:
+    """
+    Печатает различия двух состояний БД
+    :return: количество различающихся строк
+    """
+    differences = 0
+    for table in ('couriers', 'orders'):
+        keys = sorted(set(old.get(table, {})) | set(new.get(table, {})), key=int)
+        changed = [k for k in keys if old.get(table, {}).get(k) != new.get(table, {}).get(k)]
+        differences += len(changed)
+        print(f'{table}: {len(changed)} of {len(keys)} rows differ')
+        for key in changed[:examples]:
+            print(f'  {key}: {old.get(table, {}).get(key)} -> {new.get(table, {}).get(key)}')
+    return differences
+
+
+async def main(path: str, speedup: float, concurrency: int, db: str, state: Optional[str], base: Optional[str]):
+    from database import TORTOISE_ORM
+    from helpers import rate_limit
+    from main import app
+    from models.courier_types import courier_types
+    from models.open_orders import open_orders
+    from models.shards import create_order_tables
+
+    # чистая БД для каждого прогона; реплика не нужна, ограничения частоты не действуют
+    TORTOISE_ORM['connections']['default'] = db
+    TORTOISE_ORM['connections'].pop('replica', None)
+    rate_limit.route_limits.clear()
+    await Tortoise.init(config=TORTOISE_ORM)
+    await Tortoise.generate_schemas(safe=True)
+    await create_order_tables()
+    await courier_types.load()
+    if open_orders.enabled:
+        await open_orders.reload()
+
+    report(await replay(app, load(path), speedup, concurrency))
+    current = json.loads(json.dumps(await snapshot(), default=str))
+    if state:
+        with open(state, 'w') as file:
+            json.dump(current, file)
+    if base:
+        with open(base) as file:
+            compare(json.load(file), current)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных запросов')
+    parser.add_argument('log', help='файл с запросами (RECORD_REQUESTS)')
+    parser.add_argument('--speedup', type=float, default=0, help='ускорение относительно записи (0 - без пауз)')
+    parser.add_argument('--concurrency', type=int, default=1, help='одновременных запросов (1)')
+    parser.add_argument('--db', default='sqlite://:memory:', help='БД для прогона (sqlite://:memory:)')
+    parser.add_argument('--state', help='куда сохранить состояние БД после прогона')
+    parser.add_argument('--compare', help='состояние предыдущего прогона для сравнения')
+    args = parser.parse_args()
+    run_async(main(args.log, args.speedup, args.concurrency, args.db, args.state, args.compare))
@@ -1,16 +1,30 @@
 from fastapi import APIRouter
 from uris.post_couriers import post_couriers_route
 from uris.patch_couriers import patch_couriers_route
+from uris.patch_couriers_batch import patch_couriers_batch_route
 from uris.post_orders import post_orders_route
 from uris.post_orders_assign import post_orders_assign_route
 from uris.post_orders_complete import post_orders_complete_route
+from uris.post_orders_complete_batch import post_orders_complete_batch_route
 from uris.get_courier import get_couriers_route
+from uris.post_couriers_query import post_couriers_query_route
+from uris.get_courier_orders import get_courier_orders_route
+from uris.get_courier_assignments_stream import get_courier_assignments_stream_route
+from uris.get_export import get_export_route
+from uris.get_metrics import get_metrics_route
 
 router = APIRouter()
 
 router.include_router(post_couriers_route)
 router.include_router(patch_couriers_route)
+router.include_router(patch_couriers_batch_route)
 router.include_router(post_orders_route)
 router.include_router(post_orders_assign_route)
 router.include_router(post_orders_complete_route)
+router.include_router(post_orders_complete_batch_route)
 router.include_router(get_couriers_route)
+router.include_router(post_couriers_query_route)
+router.include_router(get_courier_orders_route)
+router.include_router(get_courier_assignments_stream_route)
+router.include_router(get_export_route)
+router.include_router(get_metrics_route)
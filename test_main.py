@@ -1,11 +1,42 @@
 from typing import Generator
 import asyncio
+import base64
+import json
+import os
+import sqlite3
+import subprocess
+import sys
 from fastapi.testclient import TestClient
 import pytest
+from tortoise import Tortoise
 from tortoise.contrib.test import finalizer, initializer
+from tortoise.utils import get_schema_sql
 import datetime as dt
+from collections import OrderedDict
 
-from main import app
+# в тестах схемы БД создаются при запуске приложения, а не через migrate.py
+os.environ['GENERATE_SCHEMAS'] = '1'
+# реплика без таблиц: чтение профиля курьера с неё падает, и приложение должно перейти на основную БД
+os.environ['DB_REPLICA_URL'] = 'sqlite://:memory:'
+os.environ['REPLICA_MAX_LAG'] = '0'
+
+from main import app  # noqa: E402
+from models.open_orders import open_orders  # noqa: E402
+from models import replica  # noqa: E402
+from models.replica import read_connection  # noqa: E402
+from models.courier import Courier, CourierDB  # noqa: E402
+from models.feed import feed  # noqa: E402
+from uris.get_courier_assignments_stream import events  # noqa: E402
+from models.order import Order, OrderDB  # noqa: E402
+from archive import archive_orders  # noqa: E402
+from audit import audit_assigned_weight  # noqa: E402
+from helpers import rate_limit  # noqa: E402
+from helpers.recorder import RecordMiddleware  # noqa: E402
+from helpers.time_translate import hours_to_bitmap, bitmap_to_bytes  # noqa: E402
+from helpers.tracing import TracingMiddleware, tracer, trace_connections  # noqa: E402
+import replay  # noqa: E402
+from models.courier_types import CourierTypes, CourierTypeDB, courier_types  # noqa: E402
+from models.group_commit import group_commit  # noqa: E402
 
 client = TestClient(app)
 
@@ -329,3 +360,640 @@ def test_get_courier(client: TestClient, event_loop: asyncio.AbstractEventLoop):
         'rating': 4.65,
         'earnings': 3000
     }
+
+
+def test_get_courier_orders(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # у первого курьера все назначенные заказы уже выполнены
+    response = client.get('/couriers/1/orders')
+    assert response.status_code == 200
+    assert response.json() == {'orders': [], 'after': None}
+    response = client.get('/couriers/1/orders', params={'status': 'completed'})
+    assert response.json() == {'orders': [{'id': 1}, {'id': 3}, {'id': 4}], 'after': None}
+    # постраничная выдача
+    response = client.get('/couriers/1/orders', params={'status': 'completed', 'limit': 2})
+    assert response.json() == {'orders': [{'id': 1}, {'id': 3}], 'after': 3}
+    response = client.get('/couriers/1/orders', params={'status': 'completed', 'limit': 2, 'after': 3})
+    assert response.json() == {'orders': [{'id': 4}], 'after': None}
+    # у третьего курьера остался один назначенный заказ
+    response = client.get('/couriers/3/orders', params={'status': 'assigned'})
+    assert response.json() == {'orders': [{'id': 2}], 'after': None}
+    # несуществующий курьер и неверный статус
+    assert client.get('/couriers/100/orders').status_code == 404
+    assert client.get('/couriers/1/orders', params={'status': 'foo'}).status_code == 422
+
+
+def test_post_orders_complete_batch(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    client.post('/orders', json={
+        'data': [
+            {
+                'order_id': 10,
+                'weight': 1,
+                'region': 3,
+                'delivery_hours': ['11:10-11:20']
+            },
+            {
+                'order_id': 11,
+                'weight': 1,
+                'region': 3,
+                'delivery_hours': ['11:10-11:20']
+            }
+        ]
+    })
+    response = client.post('/orders/assign', json={'courier_id': 2})
+    assert response.json()['orders'] == [{'id': 5}, {'id': 10}, {'id': 11}]
+    assign_time = dt.datetime.fromisoformat(response.json()['assign_time'])
+    # заказ 10 назначен не третьему курьеру, поэтому весь пакет отклоняется
+    response = client.post('/orders/complete/batch', json={'data': [
+        {'courier_id': 2, 'order_id': 5, 'complete_time': (assign_time + dt.timedelta(seconds=300)).isoformat()},
+        {'courier_id': 3, 'order_id': 10, 'complete_time': (assign_time + dt.timedelta(seconds=600)).isoformat()}
+    ]})
+    assert response.status_code == 400
+    assert response.json() == {'validation_error': {'orders': [{'id': 10}]}}
+    # заказы переданы не по порядку выполнения: 11 выполнен за 100 секунд, 5 - за 200, 10 - за 300
+    response = client.post('/orders/complete/batch', json={'data': [
+        {'courier_id': 2, 'order_id': 5, 'complete_time': (assign_time + dt.timedelta(seconds=300)).isoformat()},
+        {'courier_id': 2, 'order_id': 10, 'complete_time': (assign_time + dt.timedelta(seconds=600)).isoformat()},
+        {'courier_id': 2, 'order_id': 11, 'complete_time': (assign_time + dt.timedelta(seconds=100)).isoformat()}
+    ]})
+    assert response.status_code == 200
+    assert response.json() == {'orders': [{'id': 5}, {'id': 10}, {'id': 11}]}
+    response = client.get('/couriers/2')
+    assert response.json()['rating'] == 4.72
+    assert response.json()['earnings'] == 13500
+    assert client.get('/couriers/2/orders').json() == {'orders': [], 'after': None}
+
+
+def test_patch_couriers_batch(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # курьера 100 не существует, а у второго курьера передан пустой список регионов - пакет отклоняется целиком
+    response = client.patch('/couriers', json={'data': [
+        {'courier_id': 1, 'working_hours': ['09:00-18:00']},
+        {'courier_id': 2, 'regions': []},
+        {'courier_id': 100, 'courier_type': 'car'}
+    ]})
+    assert response.status_code == 400
+    assert response.json() == {'validation_error': {'couriers': [{'id': 2}, {'id': 100}]}}
+    # третий курьер становится пешим и больше не может везти заказ 2 весом 12 кг
+    response = client.patch('/couriers', json={'data': [
+        {'courier_id': 1, 'working_hours': ['09:00-18:00']},
+        {'courier_id': 3, 'courier_type': 'foot'}
+    ]})
+    assert response.status_code == 200
+    assert response.json() == {'couriers': [
+        {
+            'courier_id': 1,
+            'courier_type': 'foot',
+            'regions': [1, 2, 3, 4],
+            'working_hours': ['09:00-18:00']
+        },
+        {
+            'courier_id': 3,
+            'courier_type': 'foot',
+            'regions': [2],
+            'working_hours': ['10:00-18:00']
+        }
+    ]}
+    assert client.get('/couriers/3/orders').json() == {'orders': [], 'after': None}
+    # освобождённый заказ снова можно назначить
+    response = client.post('/orders/assign', json={'courier_id': 2})
+    assert response.json()['orders'] == [{'id': 2}]
+
+
+def test_open_orders_snapshot(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    open_orders.enabled = True
+    open_orders.clear()
+    try:
+        client.post('/orders', json={
+            'data': [
+                {
+                    'order_id': 20,
+                    'weight': 1,
+                    'region': 4,
+                    'delivery_hours': ['09:00-18:00']
+                },
+                {
+                    'order_id': 21,
+                    'weight': 30,
+                    'region': 4,
+                    'delivery_hours': ['09:00-18:00']
+                }
+            ]
+        })
+        # заказ 21 слишком тяжёлый для пешего курьера
+        response = client.post('/orders/assign', json={'courier_id': 1})
+        assert response.json()['orders'] == [{'id': 20}]
+        assert open_orders.stats()['orders'] == 1
+        # заказа 99 нет в БД (снимок устарел), поэтому он не назначается и удаляется из снимка
+        open_orders.add(99, 1, 4, ['09:00-18:00'])
+        response = client.post('/orders/assign', json={'courier_id': 1})
+        assert response.json()['orders'] == [{'id': 20}]
+        assert open_orders.stats()['orders'] == 1
+        # одновременные запросы к незагруженному снимку ждут одну общую загрузку
+        open_orders.clear()
+        reloads = open_orders.reloads
+        event_loop.run_until_complete(asyncio.gather(*(open_orders.candidates([4], 50) for _ in range(5))))
+        assert open_orders.reloads == reloads + 1
+        # фоновая сверка возвращает в снимок заказ, который он потерял (например, созданный другим воркером)
+        event_loop.run_until_complete(open_orders.stop())
+        max_age, open_orders.max_age = open_orders.max_age, 0.01
+        open_orders.discard(21)
+        open_orders.start()
+        event_loop.run_until_complete(asyncio.sleep(0.1))
+        event_loop.run_until_complete(open_orders.stop())
+        open_orders.max_age = max_age
+        assert 21 in open_orders.index
+        metrics = client.get('/metrics').text
+        assert 'open_orders_snapshot_orders 1' in metrics and 'open_orders_snapshot_enabled 1' in metrics
+        assert f'open_orders_snapshot_reloads_total {open_orders.reloads}' in metrics
+    finally:
+        open_orders.enabled = False
+        open_orders.clear()
+
+
+def test_idempotency_key(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    response = client.post('/orders/assign', json={'courier_id': 3}, headers={'Idempotency-Key': 'assign-3'})
+    assert response.json() == {'orders': []}
+    client.post('/orders', json={
+        'data': [
+            {
+                'order_id': 30,
+                'weight': 1,
+                'region': 2,
+                'delivery_hours': ['10:00-11:00']
+            }
+        ]
+    })
+    # повтор с тем же ключом получает сохранённый ответ, хотя подходящий заказ уже появился
+    response = client.post('/orders/assign', json={'courier_id': 3}, headers={'Idempotency-Key': 'assign-3'})
+    assert response.status_code == 200
+    assert response.json() == {'orders': []}
+    response = client.post('/orders/assign', json={'courier_id': 3}, headers={'Idempotency-Key': 'assign-3-retry'})
+    assert response.json()['orders'] == [{'id': 30}]
+    complete = {
+        'courier_id': 3,
+        'order_id': 30,
+        'complete_time': (dt.datetime.fromisoformat(response.json()['assign_time']) +
+                          dt.timedelta(seconds=60)).isoformat()
+    }
+    response = client.post('/orders/complete', json=complete, headers={'Idempotency-Key': 'complete-30'})
+    assert response.json() == {'order_id': 30}
+    response = client.post('/orders/complete', json=complete, headers={'Idempotency-Key': 'complete-30'})
+    assert response.json() == {'order_id': 30}
+    assert client.get('/couriers/3').json()['earnings'] == 1000
+    # тот же ключ с другим телом не получает чужой ответ
+    response = client.post('/orders/assign', json={'courier_id': 2}, headers={'Idempotency-Key': 'assign-3'})
+    assert response.status_code == 422
+
+
+def test_read_replica(client: TestClient, event_loop: asyncio.AbstractEventLoop, monkeypatch):
+    # профиль читается с реплики, а при её ошибке (в реплике нет таблиц) - с основной БД
+    assert read_connection(3) is not None
+    response = client.get('/couriers/3')
+    assert response.status_code == 200
+    assert response.json()['earnings'] == 1000
+    assert client.get('/couriers/100').status_code == 404
+    # реплика со схемой и копией курьера, в которой заработок отличается от основной БД
+    db = Tortoise.get_connection('replica')
+    event_loop.run_until_complete(db.execute_script(get_schema_sql(Tortoise.get_connection('default'), safe=True)))
+    courier = event_loop.run_until_complete(CourierDB.get(courier_id=3))
+    event_loop.run_until_complete(CourierDB.create(
+        using_db=db, **{**{field: getattr(courier, field) for field in CourierDB._meta.db_fields}, 'earnings': 777}
+    ))
+    assert client.get('/couriers/3').json()['earnings'] == 777
+    assert client.post('/couriers/query', json={'ids': [3]}).json()['couriers'][0]['earnings'] == 777
+    # в течение REPLICA_MAX_LAG после изменения курьер читается с основной БД
+    monkeypatch.setattr(replica, 'REPLICA_MAX_LAG', 60)
+    event_loop.run_until_complete(event_loop.run_until_complete(Courier.get(id=3)).save())
+    assert read_connection(3) is None
+    assert client.get('/couriers/3').json()['earnings'] == 1000
+    assert client.post('/couriers/query', json={'ids': [3]}).json()['couriers'][0]['earnings'] == 1000
+    # курьер, которого реплика ещё не получила, читается с основной БД
+    monkeypatch.undo()
+    assert client.get('/couriers/2').status_code == 200
+    event_loop.run_until_complete(CourierDB.filter().using_db(db).delete())
+
+
+def test_assignments_stream(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    assert client.get('/couriers/100/assignments/stream').status_code == 404
+    # третий курьер (пеший, район 2, 10:00-18:00) подключается к потоку событий
+    stream = events(event_loop.run_until_complete(Courier.get(id=3)))
+    first = event_loop.create_task(stream.__anext__())
+    event_loop.run_until_complete(asyncio.sleep(0))
+    assert feed.stats() == {'subscriptions': 1}
+    client.post('/orders', json={
+        'data': [
+            {
+                # слишком тяжёлый для пешего курьера
+                'order_id': 40,
+                'weight': 20,
+                'region': 2,
+                'delivery_hours': ['10:00-11:00']
+            },
+            {
+                'order_id': 41,
+                'weight': 1,
+                'region': 2,
+                'delivery_hours': ['10:00-11:00']
+            }
+        ]
+    })
+    assert event_loop.run_until_complete(first) == 'event: order\ndata: {"id": 41}\n\n'
+    event_loop.run_until_complete(stream.aclose())
+    assert feed.stats() == {'subscriptions': 0}
+
+
+def test_archive_orders(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    before = client.get('/couriers/2').json()
+    completed = client.get('/couriers/2/orders?status=completed').json()
+    # переносим в архив все выполненные заказы
+    assert event_loop.run_until_complete(archive_orders(-1)) > 0
+    assert event_loop.run_until_complete(OrderDB.filter(completed=True).count()) == 0
+    assert event_loop.run_until_complete(archive_orders(-1)) == 0
+    # рейтинг, заработок и список выполненных заказов не изменились
+    assert client.get('/couriers/2').json() == before
+    assert client.get('/couriers/2/orders?status=completed').json() == completed
+    assert client.get('/couriers/2/orders?status=completed&limit=2').json() == {
+        'orders': completed['orders'][:2], 'after': completed['orders'][1]['id']
+    }
+
+
+def test_export(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    assert client.get('/export/users').status_code == 422
+    response = client.get('/export/couriers')
+    assert response.status_code == 200
+    # курьеры выгружаются только целиком: без водяного знака, а since не принимается
+    assert 'X-Export-Watermark' not in response.headers
+    assert client.get('/export/couriers', params={'since': '2021-01-01T00:00:00'}).status_code == 400
+    lines = response.text.splitlines()
+    assert lines[0] == 'courier_id,courier_type,regions,working_hours,assign_time,assigns,completed,' \
+                       'last_completed,earnings,assigned_weight'
+    assert lines[2].startswith('2,car,"[1, 2, 3, 4]","[""11:00-11:50""]"')
+    client.post('/couriers', json={'data': [
+        {'courier_id': 51, 'courier_type': 'car', 'regions': [51], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': i, 'weight': 1, 'region': 51, 'delivery_hours': ['10:00-11:00']} for i in (51, 52)
+    ]})
+    assign_time = client.post('/orders/assign', json={'courier_id': 51}).json()['assign_time']
+    # в полной выгрузке заказов есть и перенесённые в архив заказы
+    response = client.get('/export/orders')
+    orders = [line.split(',')[0] for line in response.text.splitlines()[1:]]
+    assert '5' in orders and '41' in orders
+    watermark = response.headers['X-Export-Watermark']
+    # в следующую выгрузку попадают только заказы, изменённые на сервере после водяного знака
+    client.post('/orders', json={'data': [{'order_id': 50, 'weight': 1, 'region': 1,
+                                          'delivery_hours': ['10:00-11:00']}]})
+    # выполнение, синхронизированное позже: complete_time раньше водяного знака
+    complete_time = (dt.datetime.fromisoformat(assign_time) + dt.timedelta(seconds=60)).isoformat()
+    client.post('/orders/complete', json={'courier_id': 51, 'order_id': 51, 'complete_time': complete_time})
+    # снятие назначения при смене часов работы
+    client.patch('/couriers/51', json={'working_hours': ['19:00-20:00']})
+    lines = client.get('/export/orders', params={'since': watermark}).text.splitlines()
+    orders = {line.split(',')[0]: line for line in lines[1:]}
+    assert sorted(orders) == ['50', '51', '52']
+    assert orders['50'].startswith('50,1.0,1,"[""10:00-11:00""]",,False,,,')
+    assert orders['51'].startswith('51,1.0,51,"[""10:00-11:00""]",51,True,60,')
+    assert orders['52'].startswith('52,1.0,51,"[""10:00-11:00""]",,False,,,')
+
+
+def test_rate_limit(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # по умолчанию ограничений нет
+    assert rate_limit.route_limits == []
+    limit, = rate_limit.parse_limits('GET /couriers/{id}=0/2/100')
+    rate_limit.route_limits.append(limit)
+    # пачка из двух запросов проходит, третий сразу получает 429
+    assert client.get('/couriers/1').status_code == 200
+    assert client.get('/couriers/1/orders').status_code == 200
+    assert client.get('/couriers/1').status_code == 200
+    assert client.get('/couriers/1').status_code == 429
+    # X-Forwarded-For от недоверенного адреса не меняет клиента
+    assert client.get('/couriers/1', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 429
+    # за доверенным прокси у каждого клиента своя корзина, адрес подставленный самим клиентом не учитывается
+    rate_limit.RATE_LIMIT_TRUSTED_PROXIES.add('testclient')
+    assert client.get('/couriers/1', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 200
+    assert client.get('/couriers/1', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 200
+    assert client.get('/couriers/1', headers={'X-Forwarded-For': '1.1.1.1, 10.0.0.1'}).status_code == 429
+    assert client.get('/couriers/1', headers={'X-Forwarded-For': '10.0.0.2'}).status_code == 200
+    rate_limit.RATE_LIMIT_TRUSTED_PROXIES.discard('testclient')
+    # маршрут занят - 503
+    limit.rate, limit.burst, limit.buckets = 50, 100, OrderedDict()
+    limit.active = limit.concurrency
+    assert client.get('/couriers/1').status_code == 503
+    limit.active = 0
+    metrics = client.get('/metrics').text
+    assert 'rate_limit_limited_total{route="GET /couriers/{id}"} 3' in metrics
+    assert 'rate_limit_shed_total{route="GET /couriers/{id}"} 1' in metrics
+    rate_limit.route_limits.remove(limit)
+
+
+def test_replay(client: TestClient, event_loop: asyncio.AbstractEventLoop, tmp_path):
+    log = tmp_path / 'requests.log'
+    recorder = RecordMiddleware(app, path=str(log))
+    records = [
+        {'ts': 0, 'method': 'POST', 'path': '/orders', 'query': '', 'headers': {'content-type': 'application/json'},
+         'client': 'replay', 'body': '{"data": [{"order_id": 60, "weight": 1, "region": 1, '
+                                     '"delivery_hours": ["09:00-18:00"]}]}'},
+        {'ts': 1, 'method': 'GET', 'path': '/couriers/1/orders', 'query': 'status=completed', 'headers': {},
+         'client': 'replay', 'body': ''},
+        {'ts': 2, 'method': 'GET', 'path': '/couriers/100', 'query': '', 'headers': {}, 'client': 'replay', 'body': ''},
+        # тело не в UTF-8 записывается и воспроизводится без потерь
+        {'ts': 3, 'method': 'POST', 'path': '/couriers', 'query': '', 'headers': {'content-type': 'text/plain'},
+         'client': 'replay', 'body_base64': base64.b64encode(b'\xff\xfe').decode('ascii')}
+    ]
+    stats = event_loop.run_until_complete(replay.replay(recorder, records, routes=app.router.routes))
+    recorder.file.close()
+    assert {route: dict(values['statuses']) for route, values in stats.items()} == {
+        'POST /orders': {201: 1}, 'GET /couriers/{id}/orders': {200: 1}, 'GET /couriers/{id}': {404: 1},
+        'POST /couriers': {422: 1}
+    }
+    assert stats['POST /orders']['queries'] > 0
+    # записанные запросы совпадают с воспроизведёнными
+    assert [{**record, 'ts': 0} for record in replay.load(str(log))] == [{**record, 'ts': 0} for record in records]
+    state = event_loop.run_until_complete(replay.snapshot())
+    assert state['orders']['60'] == {'order_id': 60, 'weight': 1.0, 'region': 1, 'delivery_hours': '["09:00-18:00"]',
+                                     'courier_id': None, 'completed': False}
+    assert replay.compare(state, state) == 0
+
+
+def test_courier_types(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    courier = {'courier_id': 70, 'courier_type': 'scooter', 'regions': [70], 'working_hours': ['09:00-18:00']}
+    assert client.post('/couriers', json={'data': [courier]}).status_code == 400
+    # новый тип курьера добавляется строкой в таблицу типов
+    event_loop.run_until_complete(CourierTypes.seed())
+    event_loop.run_until_complete(CourierTypeDB.create(name='scooter', max_weight=20, pay_rate=7))
+    event_loop.run_until_complete(courier_types.load())
+    assert client.post('/couriers', json={'data': [courier]}).status_code == 201
+    client.post('/orders', json={'data': [
+        {'order_id': 70, 'weight': 15, 'region': 70, 'delivery_hours': ['10:00-11:00']},
+        {'order_id': 71, 'weight': 10, 'region': 70, 'delivery_hours': ['10:00-11:00']}
+    ]})
+    # второй заказ не помещается в грузоподъёмность самоката
+    assert client.post('/orders/assign', json={'courier_id': 70}).json()['orders'] == [{'id': 70}]
+    response = client.post('/orders/complete', json={
+        'courier_id': 70, 'order_id': 70, 'complete_time': dt.datetime.utcnow().isoformat()
+    })
+    assert response.status_code == 200
+    assert client.get('/couriers/70').json()['earnings'] == 3500
+    # параметры подбора типа: пересечение не меньше 30 минут и не больше двух заказов одновременно
+    event_loop.run_until_complete(CourierTypeDB.create(name='cargo', max_weight=50, pay_rate=9, min_overlap=30,
+                                                       max_orders=2))
+    event_loop.run_until_complete(courier_types.load())
+    client.post('/couriers', json={'data': [
+        {'courier_id': 71, 'courier_type': 'cargo', 'regions': [71], 'working_hours': ['09:00-10:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': 171, 'weight': 1, 'region': 71, 'delivery_hours': ['09:50-11:00']},
+        *({'order_id': i, 'weight': 1, 'region': 71, 'delivery_hours': ['09:00-09:40']} for i in (172, 173, 174))
+    ]})
+    assert client.post('/orders/assign', json={'courier_id': 71}).json()['orders'] == [{'id': 172}, {'id': 173}]
+
+
+def test_audit_assigned_weight(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # после всех назначений, выполнений и изменений курьеров сохранённый вес совпадает с настоящим
+    assert event_loop.run_until_complete(audit_assigned_weight()) == []
+    event_loop.run_until_complete(CourierDB.filter(courier_id=1).update(assigned_weight=100))
+    drift = event_loop.run_until_complete(audit_assigned_weight(repair=True))
+    assert [(courier_id, stored) for courier_id, stored, actual in drift] == [(1, 100)]
+    assert event_loop.run_until_complete(audit_assigned_weight()) == []
+    # заказ числится за курьером, но потерян в его списке назначенных заказов
+    client.post('/couriers', json={'data': [
+        {'courier_id': 75, 'courier_type': 'car', 'regions': [75], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': i, 'weight': 2, 'region': 75, 'delivery_hours': ['10:00-11:00']} for i in (75, 76)
+    ]})
+    assert client.post('/orders/assign', json={'courier_id': 75}).json()['orders'] == [{'id': 75}, {'id': 76}]
+    event_loop.run_until_complete(CourierDB.filter(courier_id=75).update(assigns='76', assigned_weight=2))
+    assert event_loop.run_until_complete(audit_assigned_weight(repair=True)) == [(75, 2, 4)]
+    # курьер о заказе-сироте не знает, поэтому заказ освобождается
+    courier = event_loop.run_until_complete(Courier.get(75))
+    assert courier.assigns == [76] and courier.assigned_weight == 2
+    assert event_loop.run_until_complete(audit_assigned_weight()) == []
+    assert client.post('/orders/assign', json={'courier_id': 75}).json()['orders'] == [{'id': 76}, {'id': 75}]
+
+
+def test_shard_write_undo(client: TestClient, event_loop: asyncio.AbstractEventLoop, monkeypatch):
+    client.post('/couriers', json={'data': [
+        {'courier_id': 77, 'courier_type': 'car', 'regions': [77], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': 77, 'weight': 1, 'region': 77, 'delivery_hours': ['10:00-11:00']}
+    ]})
+
+    async def fail(self):
+        raise RuntimeError('courier is not saved')
+
+    # курьер не сохранился: назначение заказа (в шарде - уже записанное) отменяется
+    monkeypatch.setattr(Courier, 'save', fail)
+    with pytest.raises(RuntimeError):
+        client.post('/orders/assign', json={'courier_id': 77})
+    monkeypatch.undo()
+    assert event_loop.run_until_complete(Order.get(77)).courier_id is None
+    assert event_loop.run_until_complete(audit_assigned_weight()) == []
+    assert client.post('/orders/assign', json={'courier_id': 77}).json()['orders'] == [{'id': 77}]
+
+
+def test_assign_overnight_hours(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # смена через полночь покрывает и конец, и начало суток
+    client.post('/couriers', json={'data': [
+        {'courier_id': 80, 'courier_type': 'car', 'regions': [80], 'working_hours': ['22:00-02:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': 80, 'weight': 1, 'region': 80, 'delivery_hours': ['01:00-01:30']},
+        {'order_id': 81, 'weight': 1, 'region': 80, 'delivery_hours': ['02:01-21:59']},
+        {'order_id': 82, 'weight': 1, 'region': 80, 'delivery_hours': ['21:00-22:00']}
+    ]})
+    assert client.post('/orders/assign', json={'courier_id': 80}).json()['orders'] == [{'id': 80}, {'id': 82}]
+
+
+def test_tracing(client: TestClient, event_loop: asyncio.AbstractEventLoop, tmp_path):
+    client.post('/couriers', json={'data': [
+        {'courier_id': 90, 'courier_type': 'car', 'regions': [90], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': 90, 'weight': 1, 'region': 90, 'delivery_hours': ['10:00-11:00']}
+    ]})
+    path, tracer.path, tracer.file = tracer.path, str(tmp_path / 'trace.log'), None
+    try:
+        trace_connections()
+        traced_app = TracingMiddleware(app, routes=app.router.routes)
+        record = {'method': 'POST', 'path': '/orders/assign', 'query': '', 'client': 'test',
+                  'headers': {'content-type': 'application/json',
+                              'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'},
+                  'body': '{"courier_id": 90}'}
+        assert event_loop.run_until_complete(replay.call(traced_app, record)) == 200
+        # запрос без флага sampled в traceparent не трассируется
+        record['headers']['traceparent'] = '00-0af7651916cd43dd8448eb211c80319d-b7ad6b7169203331-00'
+        event_loop.run_until_complete(replay.call(traced_app, record))
+        tracer.file.close()
+    finally:
+        tracer.path, tracer.file = path, None
+    # одна строка OTLP/JSON на трассу
+    lines = [json.loads(line) for line in (tmp_path / 'trace.log').read_text().splitlines()]
+    assert len(lines) == 1
+    resource_spans, = lines[0]['resourceSpans']
+    assert resource_spans['resource']['attributes'] == \
+        [{'key': 'service.name', 'value': {'stringValue': 'candy-delivery'}}]
+    scope_spans, = resource_spans['scopeSpans']
+    spans = scope_spans['spans']
+    assert {span['traceId'] for span in spans} == {'0af7651916cd43dd8448eb211c80319c'}
+    root = spans[0]
+    assert (root['name'], root['parentSpanId'], root['kind']) == ('POST /orders/assign', 'b7ad6b7169203331', 2)
+    assert {'key': 'http.status_code', 'value': {'intValue': '200'}} in root['attributes']
+    assert {'key': 'http.method', 'value': {'stringValue': 'POST'}} in root['attributes']
+    names = {span['name'] for span in spans}
+    assert {'Courier.get', 'Courier.find_and_assign_orders', 'OrderRecord.fetch', 'SELECT', 'UPDATE'} <= names
+    # каждый спан лежит внутри родителя
+    by_id = {span['spanId']: span for span in spans}
+    for span in spans[1:]:
+        parent = by_id[span['parentSpanId']]
+        assert int(parent['startTimeUnixNano']) <= int(span['startTimeUnixNano']) <= \
+            int(span['endTimeUnixNano']) <= int(parent['endTimeUnixNano'])
+
+
+def test_post_couriers_query(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    ids = [2, 1, 100, 3, 70, 2]
+    response = client.post('/couriers/query', json={'ids': ids})
+    assert response.status_code == 200
+    result = response.json()
+    # профили совпадают с GET /couriers/{id} (включая рейтинг по архивным заказам), повторы id отбрасываются
+    assert [courier['courier_id'] for courier in result['couriers']] == [2, 1, 3, 70]
+    for courier in result['couriers']:
+        assert courier == client.get(f'/couriers/{courier["courier_id"]}').json()
+    assert result['not_found'] == [100]
+    # у курьера без выполненных заказов рейтинга нет, и GET /couriers/{id} отдаёт тот же профиль
+    profile = client.post('/couriers/query', json={'ids': [90]}).json()['couriers'][0]
+    assert 'rating' not in profile and client.get('/couriers/90').json() == profile
+    assert client.post('/couriers/query', json={'ids': []}).status_code == 400
+
+
+def test_group_commit(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    client.post('/couriers', json={'data': [
+        {'courier_id': 95, 'courier_type': 'car', 'regions': [95], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': i, 'weight': 1, 'region': 95, 'delivery_hours': ['10:00-11:00']} for i in (95, 96, 97)
+    ]})
+    assigned = client.post('/orders/assign', json={'courier_id': 95}).json()['orders']
+    assert assigned == [{'id': 95}, {'id': 96}, {'id': 97}]
+
+    def complete(courier_id, order_id):
+        return {'method': 'POST', 'path': '/orders/complete', 'query': '', 'client': 'test',
+                'headers': {'content-type': 'application/json'},
+                'body': json.dumps({'courier_id': courier_id, 'order_id': order_id,
+                                    'complete_time': dt.datetime.utcnow().isoformat()})}
+
+    window, group_commit.window = group_commit.window, 0.05
+    committed = group_commit.committed
+    try:
+        statuses = event_loop.run_until_complete(asyncio.gather(
+            *(replay.call(app, complete(95, i)) for i in (95, 96, 97)), replay.call(app, complete(1, 96))
+        ))
+    finally:
+        group_commit.window = window
+    # одновременные выполнения зафиксированы одной пачкой, ошибка одного запроса не мешает остальным
+    assert statuses == [200, 200, 200, 400]
+    assert group_commit.committed == committed + 1
+    assert f'group_commit_batches_total {committed + 1}' in client.get('/metrics').text
+    # операции пачки видят записи предыдущих: оплата и выполненные заказы не теряются
+    courier = event_loop.run_until_complete(CourierDB.get(courier_id=95)).dump()
+    assert (courier['earnings'], courier['completed'], courier['assigns'], courier['assigned_weight']) == \
+        (13500, [95, 96, 97], [], 0)
+    # назначение и выполнение одного курьера в одной пачке: назначение перечитывает курьера и не затирает выполнение
+    client.post('/couriers', json={'data': [
+        {'courier_id': 98, 'courier_type': 'car', 'regions': [98], 'working_hours': ['09:00-18:00']}
+    ]})
+    client.post('/orders', json={'data': [
+        {'order_id': 98, 'weight': 1, 'region': 98, 'delivery_hours': ['10:00-11:00']}
+    ]})
+    assert client.post('/orders/assign', json={'courier_id': 98}).json()['orders'] == [{'id': 98}]
+    client.post('/orders', json={'data': [
+        {'order_id': 99, 'weight': 2, 'region': 98, 'delivery_hours': ['10:00-11:00']}
+    ]})
+    assign = {'method': 'POST', 'path': '/orders/assign', 'query': '', 'client': 'test',
+              'headers': {'content-type': 'application/json'}, 'body': json.dumps({'courier_id': 98})}
+    window, group_commit.window = group_commit.window, 0.05
+    committed = group_commit.committed
+    try:
+        statuses = event_loop.run_until_complete(asyncio.gather(replay.call(app, assign),
+                                                                replay.call(app, complete(98, 98))))
+    finally:
+        group_commit.window = window
+    assert statuses == [200, 200]
+    assert group_commit.committed == committed + 1
+    courier = event_loop.run_until_complete(CourierDB.get(courier_id=98)).dump()
+    assert (courier['earnings'], courier['completed'], courier['assigns'], courier['assigned_weight']) == \
+        (4500, [98], [99], 2)
+    # изменение курьера в той же пачке, что и выполнение, не затирает выполнение (оплачено по типу car),
+    # а заказ 99 не попадает в новые часы работы и снимается
+    patch = {'method': 'PATCH', 'path': '/couriers/98', 'query': '', 'client': 'test',
+             'headers': {'content-type': 'application/json'},
+             'body': json.dumps({'courier_type': 'foot', 'working_hours': ['19:00-20:00']})}
+    client.post('/orders', json={'data': [
+        {'order_id': 100, 'weight': 1, 'region': 98, 'delivery_hours': ['10:00-11:00']}
+    ]})
+    assert client.post('/orders/assign', json={'courier_id': 98}).json()['orders'] == [{'id': 99}, {'id': 100}]
+    window, group_commit.window = group_commit.window, 0.05
+    committed = group_commit.committed
+    try:
+        statuses = event_loop.run_until_complete(asyncio.gather(replay.call(app, complete(98, 100)),
+                                                                replay.call(app, patch)))
+    finally:
+        group_commit.window = window
+    assert statuses == [200, 200]
+    assert group_commit.committed == committed + 1
+    courier = event_loop.run_until_complete(CourierDB.get(courier_id=98)).dump()
+    assert (courier['courier_type'], courier['earnings'], courier['completed'], courier['assigns'],
+            courier['assigned_weight']) == ('foot', 9000, [98, 100], [], 0)
+    orders = {line.split(',')[0]: line for line in client.get('/export/orders').text.splitlines()}
+    assert orders['99'].startswith('99,2.0,98,"[""10:00-11:00""]",,False')
+
+
+def test_group_commit_cancelled(client: TestClient, event_loop: asyncio.AbstractEventLoop):
+    # отменённая фиксация пачки не оставляет запросы ждать вечно
+    async def operation():
+        raise asyncio.CancelledError
+
+    window, group_commit.window = group_commit.window, 0.01
+    try:
+        results = event_loop.run_until_complete(asyncio.gather(
+            group_commit.run(operation), group_commit.run(operation), return_exceptions=True
+        ))
+    finally:
+        group_commit.window = window
+    assert [type(result) for result in results] == [asyncio.CancelledError, asyncio.CancelledError]
+
+
+def test_migrate_baseline(tmp_path):
+    # БД со схемой первой версии: у заказов ещё нет ни одной из добавленных позже колонок
+    db = sqlite3.connect(str(tmp_path / 'db.sqlite'))
+    db.executescript("""
+        CREATE TABLE "courierdb" ("courier_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            "courier_type" VARCHAR(4) NOT NULL, "regions" TEXT NOT NULL, "working_hours" TEXT NOT NULL,
+            "assign_time" TIMESTAMP, "assigns" TEXT, "completed" TEXT, "last_completed" TIMESTAMP,
+            "earnings" INT NOT NULL DEFAULT 0);
+        CREATE TABLE "orderdb" ("order_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "weight" REAL NOT NULL,
+            "region" INT NOT NULL, "delivery_hours" TEXT NOT NULL, "courier_id" INT,
+            "completed" INT NOT NULL DEFAULT 0, "complete_time" INT);
+        INSERT INTO "courierdb" VALUES (1, 'car', '1', '09:00-18:00', '2021-03-01 10:00:00', '2', '1',
+            '2021-03-01 10:10:00', 4500);
+        INSERT INTO "orderdb" VALUES (1, 2, 1, '10:00-11:00', 1, 1, 600), (2, 3, 1, '10:00-11:00', 1, 0, NULL),
+            (3, 1, 1, '10:00-11:00', NULL, 0, NULL);
+    """)
+    db.commit()
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('DB', 'DB_REPLICA_URL', 'ORDER_SHARDS', 'GENERATE_SCHEMAS')}
+    migrate = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrate.py')
+    # повторный запуск миграции ничего не ломает
+    for _ in range(2):
+        subprocess.run([sys.executable, migrate], cwd=str(tmp_path), env=env, check=True, timeout=60)
+    assert db.execute('PRAGMA integrity_check').fetchall() == [('ok',)]
+    rows = db.execute('SELECT "order_id", "completed_at" IS NOT NULL, "updated_at" IS NOT NULL, "delivery_buckets" '
+                      'FROM "orderdb" ORDER BY "order_id"').fetchall()
+    assert [row[:3] for row in rows] == [(1, 1, 1), (2, 0, 1), (3, 0, 1)] and all(row[3] for row in rows)
+    # индексы построены по колонкам, а не по строковым константам
+    assert db.execute('SELECT COUNT(*) FROM "orderdb" WHERE "completed_at" = \'completed_at\'').fetchone() == (0,)
+    assert db.execute('SELECT "assigned_weight" FROM "courierdb"').fetchall() == [(3.0,)]
+    # точная маска минут заполнена и совпадает с разобранными интервалами
+    assert db.execute('SELECT DISTINCT "delivery_bitmap" FROM "orderdb"').fetchall() == \
+        [(bitmap_to_bytes(hours_to_bitmap(['10:00-11:00'])),)]
+    db.close()
@@ -1,9 +1,11 @@
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 from pydantic.main import BaseModel
+from tortoise.backends.base.client import BaseDBAsyncClient
 
 from models.courier import Courier
+from models.replica import read_connection, read_with_fallback
 
 
 class GetCourierSchemaResponse(BaseModel):
@@ -11,7 +13,7 @@ class GetCourierSchemaResponse(BaseModel):
     courier_type: str = 'foot'
     regions: List[int] = [11, 33, 2]
     working_hours: List[str] = ['09:00-18:00']
-    rating: float = 4.93
+    rating: Optional[float] = 4.93  # у курьера без выполненных заказов поля нет
     earnings: int = 10000
 
 
@@ -23,15 +25,31 @@ async def get_courier(id: int):
     # В задании нет некоторых уточнений, поэтому при рассчёте рейтинга учитываются даже те районы,
     # в которых курьер уже не работает (К примеру курьер развозил посылки по району 1, но через
     # PATCH ему заменили район 1 на район 2. Рейтинг будет рассчитываться с учётом работы по 1 району в прошлом)
+
+    # данные курьера читаются с реплики, если она настроена и курьер недавно не изменялся
+    profile = await read_with_fallback(lambda db: read_profile(id, db), read_connection(id),
+                                       lambda result: result is None)
+    if profile is None:
+        return JSONResponse(status_code=404)
+    return profile
+
+
+async def read_profile(id: int, db: Optional[BaseDBAsyncClient]) -> Optional[dict]:
+    """
+    Читает профиль курьера
+    :param id: id курьера
+    :param db: подключение для чтения (None - основная БД)
+    :return: профиль (без рейтинга, если у курьера нет выполненных заказов) или None, если курьера нет
+    """
     try:
-        courier = await Courier.get(id=id)
-        return GetCourierSchemaResponse(
-            courier_id=courier.courier_id,
-            courier_type=courier.courier_type,
-            regions=courier.regions,
-            working_hours=courier.working_hours,
-            rating=(await courier.get_rating()),
-            earnings=courier.earnings
-        )
+        courier = await Courier.get(id=id, using_db=db)
     except ValueError:
-        return JSONResponse(status_code=404)
+        return None
+    return GetCourierSchemaResponse(
+        courier_id=courier.courier_id,
+        courier_type=courier.courier_type,
+        regions=courier.regions,
+        working_hours=courier.working_hours,
+        rating=(await courier.get_rating(using_db=db)),
+        earnings=courier.earnings
+    ).dict(exclude_none=True)
@@ -0,0 +1,48 @@
+import os
+import json
+import asyncio
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from models.courier import Courier
+from models.feed import feed
+from models.courier_types import courier_types
+
+# Через сколько секунд без событий отправляется комментарий, чтобы прокси не закрыли соединение
+FEED_KEEPALIVE = float(os.getenv('FEED_KEEPALIVE', 15))
+
+get_courier_assignments_stream_route = APIRouter()
+
+
+async def events(courier: Courier):
+    """
+    Отдаёт курьеру события server-sent events о новых подходящих ему свободных заказах
+    :param courier: курьер
+    :return: асинхронный генератор строк
+    """
+    # подписка оформляется внутри генератора, чтобы она гарантированно снималась при отключении клиента
+    subscription = feed.subscribe(courier.courier_id, courier.regions,
+                                  courier_types[courier.courier_type].max_weight, courier.working_hours)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(subscription.ready.wait(), FEED_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            subscription.ready.clear()
+            while subscription.events:
+                yield 'event: order\ndata: ' + json.dumps({'id': subscription.events.popleft()}) + '\n\n'
+    finally:
+        feed.unsubscribe(subscription)
+
+
+@get_courier_assignments_stream_route.get('/couriers/{id}/assignments/stream', responses={404: {}, 200: {}})
+async def get_courier_assignments_stream(id: int):
+    # вместо периодических запросов к /orders/assign курьер держит соединение и получает id новых заказов,
+    # после чего назначает их себе через /orders/assign
+    try:
+        courier = await Courier.get(id=id)
+    except ValueError:
+        return JSONResponse(status_code=404)
+    return StreamingResponse(events(courier), media_type='text/event-stream')
@@ -0,0 +1,98 @@
+import json
+from typing import List, Optional
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic.main import BaseModel
+
+from models.courier import Courier
+from models.order import OrderDB, OrderArchiveDB
+from models.shards import fan_out
+
+# Сколько заказов читается из БД за один запрос при потоковой отдаче ответа
+CHUNK_SIZE = 500
+
+
+class GetCourierOrdersSchemaResponse(BaseModel):
+    orders: List[dict]
+    after: Optional[int]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'orders': [{'id': 1}, {'id': 3}],
+                    'after': 3
+                }
+        }
+
+
+get_courier_orders_route = APIRouter()
+
+
+def query_filters(courier_id: int, completed: bool, after: Optional[int]) -> dict:
+    """
+    Фильтры выборки заказов курьера (одинаковые для таблицы заказов и архива)
+    :return: dict
+    """
+    filters = {'courier_id': courier_id, 'completed': completed}
+    if after is not None:
+        filters['order_id__gt'] = after
+    return filters
+
+
+async def iterate_orders(courier_id: int, completed: bool, after: Optional[int], limit: Optional[int]):
+    """
+    Постранично (по ключу order_id) отдаёт id заказов курьера, не загружая весь список в память
+    :param courier_id: id курьера
+    :param completed: True - выполненные заказы, False - назначенные
+    :param after: id заказа, после которого начинается выдача
+    :param limit: максимальное количество заказов (None - без ограничения)
+    :return: асинхронный генератор id заказов
+    """
+    left = limit
+    while left is None or left > 0:
+        size = CHUNK_SIZE if left is None else min(CHUNK_SIZE, left)
+        query = OrderDB.filter(**query_filters(courier_id, completed, after))
+        # каждый шард отдаёт свои первые size заказов, из объединения берутся первые size
+        ids = await fan_out(
+            lambda db: query.using_db(db).order_by('order_id').limit(size).values_list('order_id', flat=True)
+        )
+        if completed:
+            # выполненные заказы могут быть уже перенесены в архив
+            ids += await OrderArchiveDB.filter(**query_filters(courier_id, completed, after)) \
+                .order_by('order_id').limit(size).values_list('order_id', flat=True)
+        ids = sorted(ids)[:size]
+        for order_id in ids:
+            yield order_id
+        if len(ids) < size:
+            break
+        after = ids[-1]
+        if left is not None:
+            left -= len(ids)
+
+
+async def render_orders(courier_id: int, completed: bool, after: Optional[int], limit: Optional[int]):
+    """
+    Формирует JSON ответа по частям
+    :return: асинхронный генератор строк
+    """
+    yield '{"orders": ['
+    count = 0
+    last = None
+    async for order_id in iterate_orders(courier_id, completed, after, limit):
+        yield (', ' if count else '') + json.dumps({'id': order_id})
+        count += 1
+        last = order_id
+    # курсор для следующей страницы отдаётся только если страница заполнена целиком
+    yield '], "after": ' + json.dumps(last if limit is not None and count == limit else None) + '}'
+
+
+@get_courier_orders_route.get('/couriers/{id}/orders',
+                              responses={404: {}, 200: {'model': GetCourierOrdersSchemaResponse}})
+async def get_courier_orders(id: int,
+                             status: str = Query('assigned', regex='^(assigned|completed)$'),
+                             after: Optional[int] = None,
+                             limit: Optional[int] = Query(None, gt=0)):
+    if not await Courier.exists(id):
+        return JSONResponse(status_code=404)
+    return StreamingResponse(render_orders(id, status == 'completed', after, limit), media_type='application/json')
@@ -0,0 +1,22 @@
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Path
+from fastapi.responses import JSONResponse, StreamingResponse
+from tortoise import timezone
+
+from models.export import export_csv
+
+get_export_route = APIRouter()
+
+
+@get_export_route.get('/export/{table}', responses={400: {}, 200: {'content': {'text/csv': {}}}})
+async def get_export(table: str = Path(..., regex='^(orders|couriers)$'), since: Optional[datetime] = None):
+    if table == 'couriers':
+        # у курьеров нет времени изменения, они выгружаются только целиком и без водяного знака
+        if since is not None:
+            return JSONResponse(status_code=400, content={'detail': 'Couriers are exported only in full'})
+        return StreamingResponse(export_csv(table), media_type='text/csv')
+    # водяной знак берётся до начала выгрузки: следующая выгрузка с since=watermark ничего не пропустит
+    watermark = timezone.now().isoformat()
+    return StreamingResponse(export_csv(table, since), media_type='text/csv',
+                             headers={'X-Export-Watermark': watermark})
@@ -0,0 +1,46 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from helpers import rate_limit
+from models.group_commit import group_commit
+from models.open_orders import open_orders
+
+get_metrics_route = APIRouter()
+
+# счётчик ограничений -> (имя метрики, тип)
+METRICS = {
+    'allowed': ('rate_limit_allowed_total', 'counter'),
+    'limited': ('rate_limit_limited_total', 'counter'),
+    'shed': ('rate_limit_shed_total', 'counter'),
+    'active': ('rate_limit_active', 'gauge'),
+    'rate': ('rate_limit_rate', 'gauge'),
+    'burst': ('rate_limit_burst', 'gauge'),
+    'concurrency': ('rate_limit_concurrency', 'gauge'),
+}
+
+
+@get_metrics_route.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    # текстовый формат Prometheus
+    stats = rate_limit.stats()
+    lines = []
+    for key, (name, kind) in METRICS.items():
+        lines.append(f'# TYPE {name} {kind}')
+        for route, values in stats.items():
+            lines.append(f'{name}{{route="{route}"}} {values[key]}')
+    # групповая фиксация записей: число пачек и операций в них (см. GROUP_COMMIT_WINDOW)
+    for name, value in (('group_commit_batches_total', group_commit.committed),
+                        ('group_commit_writes_total', group_commit.writes)):
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+    # снимок свободных заказов (см. OPEN_ORDERS_SNAPSHOT): размер, память, возраст и перезагрузки
+    snapshot = open_orders.stats()
+    for name, kind, value in (('open_orders_snapshot_enabled', 'gauge', int(snapshot['enabled'])),
+                              ('open_orders_snapshot_orders', 'gauge', snapshot['orders']),
+                              ('open_orders_snapshot_memory_bytes', 'gauge', snapshot['memory']),
+                              ('open_orders_snapshot_age_seconds', 'gauge', snapshot['age']),
+                              ('open_orders_snapshot_reloads_total', 'counter', snapshot['reloads'])):
+        lines.append(f'# TYPE {name} {kind}')
+        # до первой загрузки возраста нет
+        lines.append(f'{name} {"NaN" if value is None else value}')
+    return '\n'.join(lines) + '\n'
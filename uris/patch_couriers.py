@@ -4,6 +4,7 @@ from pydantic.main import BaseModel
 from fastapi.responses import JSONResponse
 
 from models.courier import Courier
+from models.group_commit import group_commit
 
 
 class CourierPatchSchemaRequest(BaseModel):
@@ -47,17 +48,21 @@ patch_couriers_route = APIRouter()
 async def update_courier(id: int, request: CourierPatchSchemaRequest):
     try:
         # Если в поступившем реквесте нет данных, которые требуется обновить, то возвращаем 400 response
-        if not request.dict(exclude_none=True):
+        data = request.dict(exclude_none=True)
+        if not data:
             return JSONResponse(status_code=400)
-        courier = await Courier.get(id=id)
-        if 'courier_type' in request.dict(exclude_none=True):
-            courier.courier_type = request.dict()['courier_type']
-        if 'regions' in request.dict(exclude_none=True):
-            courier.regions = request.dict()['regions']
-        if 'working_hours' in request.dict(exclude_none=True):
-            courier.working_hours = request.dict()['working_hours']
-        await courier.save()
-        await courier.check()
+
+        async def update():
+            # курьер читается с блокировкой строки и сохраняется в одной транзакции (или пачке групповой
+            # фиксации), чтобы не затереть одновременные назначение и выполнение
+            courier = await Courier.get(id=id, for_update=True)
+            # изменённая модель создаётся заново, чтобы новые данные прошли валидацию
+            courier = Courier(**{**courier.dict(), **data})
+            # check снимает заказы, которые курьер больше не может доставить, и сохраняет курьера
+            await courier.check()
+            return courier
+
+        courier = await group_commit.run(update)
         return CourierPatchSchemaResponse(**courier.dict())
 
     except ValueError as e:
@@ -0,0 +1,115 @@
+from collections import Counter
+from typing import List
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from pydantic.main import BaseModel
+from tortoise.transactions import in_transaction
+
+from models.courier import Courier, CourierDB
+from models.order import OrderRecord
+from models.open_orders import open_orders
+from models.feed import feed
+from models.replica import mark_written
+from uris.patch_couriers import CourierPatchSchemaRequest, CourierPatchSchemaResponse
+
+
+class CourierPatchBatchItem(CourierPatchSchemaRequest):
+    courier_id: int
+
+
+class CouriersPatchBatchSchemaRequest(BaseModel):
+    data: List[CourierPatchBatchItem]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'data': [
+                        {'courier_id': 1, 'working_hours': ['14:00-22:00']},
+                        {'courier_id': 2, 'courier_type': 'bike', 'regions': [1, 2]}
+                    ]
+                }
+        }
+
+
+class CouriersPatchBatchSchemaResponse200(BaseModel):
+    couriers: List[CourierPatchSchemaResponse]
+
+
+class CouriersPatchBatchSchemaResponse400(BaseModel):
+    validation_error: dict
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'validation_error': {'couriers': [{'id': 2}]}
+                }
+        }
+
+
+patch_couriers_batch_route = APIRouter()
+
+
+@patch_couriers_batch_route.patch('/couriers', responses={400: {'model': CouriersPatchBatchSchemaResponse400},
+                                                          200: {'model': CouriersPatchBatchSchemaResponse200}})
+async def update_couriers(request: CouriersPatchBatchSchemaRequest):
+    ids = [item.courier_id for item in request.data]
+    counts = Counter(ids)
+    # курьеры и их заказы читаются и проверяются в той же транзакции, в которой записываются: одновременные
+    # назначение или выполнение для тех же курьеров не будут перезаписаны (строки курьеров блокируются
+    # select_for_update там, где БД это поддерживает, sqlite блокирует всю БД на время транзакции)
+    async with in_transaction('default'):
+        # первый запрос - все изменяемые курьеры
+        couriers = await CourierDB.select_for_update().in_bulk(ids, 'courier_id')
+
+        errors = []
+        updated = []
+        for item in request.data:
+            data = item.dict(exclude_none=True)
+            del data['courier_id']
+            if not data or item.courier_id not in couriers or counts[item.courier_id] != 1:
+                errors.append(item.courier_id)
+                continue
+            try:
+                updated.append(Courier(**{**couriers[item.courier_id].dump(), **data}))
+            except ValueError:
+                errors.append(item.courier_id)
+        if errors:
+            return JSONResponse(status_code=400, content={
+                'validation_error': {'couriers': [{'id': i} for i in errors]}
+            })
+
+        # второй запрос (по одному на шард) - все назначенные этим курьерам и ещё не выполненные заказы
+        assigned = dict()
+        for order in await OrderRecord.fetch(courier_id__in=ids, completed=False):
+            assigned.setdefault(order.courier_id, dict())[order.order_id] = order
+
+        released = []
+        for courier in updated:
+            orders = assigned.get(courier.courier_id, dict())
+            # заказы проверяются в том же порядке, в котором они были назначены
+            matched = courier.match([orders[i] for i in courier.assigns if i in orders])
+            kept = {order.order_id for order in matched}
+            released += [orders[i] for i in courier.assigns if i in orders and i not in kept]
+            courier.assigns = [i for i in courier.assigns if i in kept]
+            courier.assigned_weight = sum(orders[i].weight for i in courier.assigns)
+            courier_db = couriers[courier.courier_id]
+            courier_db.courier_type = courier.courier_type
+            courier_db.regions = ','.join(map(str, courier.regions))
+            courier_db.working_hours = ','.join(courier.working_hours)
+            courier_db.assigns = ','.join(map(str, courier.assigns))
+            courier_db.assigned_weight = courier.assigned_weight
+
+        await CourierDB.bulk_update([couriers[i] for i in ids],
+                                    fields=['courier_type', 'regions', 'working_hours', 'assigns',
+                                            'assigned_weight'])
+        if released:
+            await OrderRecord.update(released, courier_id=None)
+    mark_written(*ids)
+    for order in released:
+        open_orders.add(order.order_id, order.weight, order.region, order.delivery_hours.split(','))
+        feed.publish(order.order_id, order.weight, order.region, order.delivery_hours.split(','))
+    return CouriersPatchBatchSchemaResponse200(
+        couriers=[CourierPatchSchemaResponse(**courier.dict()) for courier in updated]
+    )
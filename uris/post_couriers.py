@@ -10,25 +10,25 @@ class CouriersSchemaRequest(BaseModel):
     data: List
 
     class Config:
-        schema_extra = {
-            'example':
-                {
-                    'data': [
-                        Courier(courier_id=1,
-                                courier_type='foot',
-                                regions=[1, 12, 22],
-                                working_hours=['11:35-14:05', '09:00-11:00']),
-                        Courier(courier_id=2,
-                                courier_type='bike',
-                                regions=[22],
-                                working_hours=['09:00-18:00']),
-                        Courier(courier_id=3,
-                                courier_type='car',
-                                regions=[12, 22, 23, 33],
-                                working_hours=['09:00-11:00'])
-                    ]
-                }
-        }
+        @staticmethod
+        def schema_extra(schema: dict, model) -> None:
+            # пример собирается только при генерации документации, а не при импорте модуля
+            schema['example'] = {
+                'data': [
+                    Courier(courier_id=1,
+                            courier_type='foot',
+                            regions=[1, 12, 22],
+                            working_hours=['11:35-14:05', '09:00-11:00']).dict(exclude_none=True),
+                    Courier(courier_id=2,
+                            courier_type='bike',
+                            regions=[22],
+                            working_hours=['09:00-18:00']).dict(exclude_none=True),
+                    Courier(courier_id=3,
+                            courier_type='car',
+                            regions=[12, 22, 23, 33],
+                            working_hours=['09:00-11:00']).dict(exclude_none=True)
+                ]
+            }
 
 
 class CouriersSchemaResponse201(BaseModel):
@@ -0,0 +1,106 @@
+import json
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from models.courier import Courier, CourierDB
+from models.replica import read_connection, read_with_fallback
+from uris.get_courier import GetCourierSchemaResponse
+
+# Сколько курьеров читается из БД за один запрос (список id передаётся в IN)
+CHUNK_SIZE = 500
+
+
+class CouriersQuerySchemaRequest(BaseModel):
+    ids: List[int]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'ids': [2, 3, 100]
+                }
+        }
+
+
+class CouriersQuerySchemaResponse(BaseModel):
+    couriers: List[GetCourierSchemaResponse]
+    not_found: List[int]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'couriers': [
+                        {'courier_id': 2, 'courier_type': 'foot', 'regions': [11, 33, 2],
+                         'working_hours': ['09:00-18:00'], 'rating': 4.93, 'earnings': 10000},
+                        {'courier_id': 3, 'courier_type': 'car', 'regions': [1],
+                         'working_hours': ['09:00-18:00'], 'earnings': 0}
+                    ],
+                    'not_found': [100]
+                }
+        }
+
+
+post_couriers_query_route = APIRouter()
+
+
+async def load_chunk(ids: List[int], db: Optional[BaseDBAsyncClient]) -> Tuple[List[CourierDB], Dict[int, float]]:
+    """
+    Загружает курьеров одним запросом и их рейтинги одним сгруппированным запросом
+    :param ids: id курьеров
+    :param db: подключение для чтения (None - основная БД)
+    :return: курьеры и {courier_id: рейтинг}
+    """
+    couriers = await CourierDB.filter(courier_id__in=ids).using_db(db)
+    return couriers, await Courier.get_ratings(ids, using_db=db)
+
+
+def profile(courier: CourierDB, rating: Optional[float]) -> dict:
+    """
+    Профиль курьера в формате GET /couriers/{id}
+    :param courier: курьер
+    :param rating: рейтинг (None - у курьера нет выполненных заказов, поле не отдаётся)
+    :return: dict
+    """
+    data = courier.dump()
+    result = {key: data[key] for key in ('courier_id', 'courier_type', 'regions', 'working_hours')}
+    if rating is not None:
+        result['rating'] = rating
+    result['earnings'] = data['earnings']
+    return result
+
+
+async def render_couriers(ids: List[int], db: Optional[BaseDBAsyncClient]):
+    """
+    Формирует JSON ответа по частям: профили курьеров в порядке запроса, затем id не найденных курьеров
+    :return: асинхронный генератор строк
+    """
+    yield '{"couriers": ['
+    count = 0
+    not_found = []
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        couriers, ratings = await read_with_fallback(lambda connection: load_chunk(chunk, connection), db,
+                                                     lambda result: len(result[0]) < len(chunk))
+        by_id = {courier.courier_id: courier for courier in couriers}
+        for courier_id in chunk:
+            if courier_id not in by_id:
+                not_found.append(courier_id)
+                continue
+            yield (', ' if count else '') + json.dumps(profile(by_id[courier_id], ratings.get(courier_id)))
+            count += 1
+    yield '], "not_found": ' + json.dumps(not_found) + '}'
+
+
+@post_couriers_query_route.post('/couriers/query', responses={400: {}, 200: {'model': CouriersQuerySchemaResponse}})
+async def couriers_query(request: CouriersQuerySchemaRequest):
+    if not request.ids:
+        return JSONResponse(status_code=400)
+    ids = list(dict.fromkeys(request.ids))
+    # реплика используется, только если ни один из курьеров недавно не изменялся
+    connections = [read_connection(courier_id) for courier_id in ids]
+    db = None if None in connections else connections[0]
+    return StreamingResponse(render_couriers(ids, db), media_type='application/json')
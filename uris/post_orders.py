@@ -12,25 +12,25 @@ class OrdersSchemaRequest(BaseModel):
     data: List
 
     class Config:
-        schema_extra = {
-            'example':
-                {
-                    'data': [
-                        Order(order_id=1,
-                              weight=0.23,
-                              region=12,
-                              delivery_hours=["09:00-18:00"]),
-                        Order(order_id=2,
-                              weight=15,
-                              region=1,
-                              delivery_hours=["09:00-18:00"]),
-                        Order(order_id=3,
-                              weight=0.01,
-                              region=22,
-                              delivery_hours=["09:00-12:00", "16:00-21:30"])
-                    ]
-                }
-        }
+        @staticmethod
+        def schema_extra(schema: dict, model) -> None:
+            # пример собирается только при генерации документации, а не при импорте модуля
+            schema['example'] = {
+                'data': [
+                    Order(order_id=1,
+                          weight=0.23,
+                          region=12,
+                          delivery_hours=["09:00-18:00"]).dict(exclude_none=True),
+                    Order(order_id=2,
+                          weight=15,
+                          region=1,
+                          delivery_hours=["09:00-18:00"]).dict(exclude_none=True),
+                    Order(order_id=3,
+                          weight=0.01,
+                          region=22,
+                          delivery_hours=["09:00-12:00", "16:00-21:30"]).dict(exclude_none=True)
+                ]
+            }
 
 
 class OrdersSchemaResponse201(BaseModel):
@@ -1,9 +1,10 @@
 from typing import List, Optional
-from fastapi import APIRouter
+from fastapi import APIRouter, Header
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 from models.courier import Courier
+from helpers.idempotency import idempotent
 
 
 class OrdersAssignSchemaRequest(BaseModel):
@@ -37,7 +38,11 @@ post_orders_assign_route = APIRouter()
 
 @post_orders_assign_route.post('/orders/assign',
                                responses={400: {}, 200: {'model': OrdersAssignSchemaResponse}})
-async def orders_assign(request: OrdersAssignSchemaRequest):
+async def orders_assign(request: OrdersAssignSchemaRequest, idempotency_key: Optional[str] = Header(None)):
+    return await idempotent('/orders/assign', idempotency_key, request, lambda: assign_orders(request))
+
+
+async def assign_orders(request: OrdersAssignSchemaRequest):
     try:
         courier = await Courier.get(id=request.courier_id)
         await courier.find_and_assign_orders()
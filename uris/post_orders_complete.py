@@ -1,11 +1,17 @@
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, Header
 from fastapi.responses import JSONResponse
 from pydantic import validator
 from pydantic.main import BaseModel
 from datetime import datetime
+from tortoise import timezone
 
 from models.courier import Courier
-from models.order import Order
+from models.order import Order, OrderDB
+from models.shards import shard
+from models.courier_types import courier_types
+from models.group_commit import group_commit
+from helpers.idempotency import idempotent
 
 
 class OrderCompleteSchemaRequest(BaseModel):
@@ -45,32 +51,55 @@ post_orders_complete_route = APIRouter()
 
 
 @post_orders_complete_route.post('/orders/complete', responses={400: {}, 200: {'model': OrderCompleteSchemaResponse}})
-async def order_complete(request: OrderCompleteSchemaRequest):
-    try:
-        order = await Order.get(request.order_id)
-        if order.courier_id != request.courier_id:
-            raise ValueError
-        if order.completed:
-            return OrderCompleteSchemaResponse(order_id=order.order_id)
-        courier = await Courier.get(id=order.courier_id)
-
-        courier.earnings += {'car': 9, 'bike': 5, 'foot': 2}[courier.courier_type] * 500
-        courier.assigns.remove(order.order_id)
-        courier.completed.append(order.order_id)
-        order.completed = True
-        if courier.last_completed is None or courier.assign_time > courier.last_completed:
-            order.complete_time = (
-                    datetime.fromisoformat(request.complete_time) - courier.assign_time.replace(tzinfo=None)
-            ).total_seconds()
-        else:
-            order.complete_time = (
-                    datetime.fromisoformat(request.complete_time) - courier.last_completed.replace(tzinfo=None)
-            ).total_seconds()
-        courier.last_completed = datetime.fromisoformat(request.complete_time)
-
-        await courier.save()
-        await order.save()
-        return OrderCompleteSchemaResponse(order_id=order.order_id)
+async def order_complete(request: OrderCompleteSchemaRequest, idempotency_key: Optional[str] = Header(None)):
+    return await idempotent('/orders/complete', idempotency_key, request, lambda: complete_order(request))
+
 
+async def complete_order(request: OrderCompleteSchemaRequest):
+    try:
+        # при групповой фиксации заказ и курьер читаются и записываются в транзакции пачки
+        return await group_commit.run(lambda: complete(request))
     except ValueError:
         return JSONResponse(status_code=400)
+
+
+async def complete(request: OrderCompleteSchemaRequest) -> OrderCompleteSchemaResponse:
+    """
+    Отмечает заказ выполненным и начисляет оплату курьеру
+    :return: ответ или ValueError, если заказ не назначен этому курьеру
+    """
+    # строка курьера блокируется до чтения заказа: все выполнения его заказов идут по очереди, и заказ,
+    # выполненный одновременной транзакцией, уже виден выполненным
+    courier = await Courier.get(id=request.courier_id, for_update=True)
+    order = await Order.get(request.order_id)
+    if order.courier_id != request.courier_id:
+        raise ValueError
+    if order.completed:
+        return OrderCompleteSchemaResponse(order_id=order.order_id)
+
+    courier.earnings += courier_types[courier.courier_type].pay
+    courier.assigns.remove(order.order_id)
+    # без назначенных заказов вес обнуляется, чтобы не накапливалась ошибка округления
+    courier.assigned_weight = courier.assigned_weight - order.weight if courier.assigns else 0
+    courier.completed.append(order.order_id)
+    order.completed = True
+    if courier.last_completed is None or courier.assign_time > courier.last_completed:
+        order.complete_time = (
+                datetime.fromisoformat(request.complete_time) - courier.assign_time.replace(tzinfo=None)
+        ).total_seconds()
+    else:
+        order.complete_time = (
+                datetime.fromisoformat(request.complete_time) - courier.last_completed.replace(tzinfo=None)
+        ).total_seconds()
+    courier.last_completed = datetime.fromisoformat(request.complete_time)
+    order.completed_at = courier.last_completed
+
+    await courier.save()
+    await order.save()
+    db = shard(order.region)
+    if db is not None:
+        # запись в шард фиксируется сразу: если оплата курьеру не будет зафиксирована, выполнение отменяется
+        group_commit.on_rollback(lambda: OrderDB.filter(order_id=order.order_id, completed=True).using_db(db).update(
+            completed=False, complete_time=None, completed_at=None, updated_at=timezone.now()
+        ))
+    return OrderCompleteSchemaResponse(order_id=order.order_id)
@@ -0,0 +1,145 @@
+import asyncio
+from collections import Counter
+from typing import List, Optional
+from fastapi import APIRouter, Header
+from fastapi.responses import JSONResponse
+from pydantic.main import BaseModel
+from tortoise.transactions import in_transaction
+from datetime import datetime
+
+from models.courier import CourierDB
+from models.order import OrderDB
+from models.courier_types import courier_types
+from models.replica import mark_written
+from models.shards import shard, fan_out
+from uris.post_orders_complete import OrderCompleteSchemaRequest
+from helpers.idempotency import idempotent
+
+
+class OrdersCompleteBatchSchemaRequest(BaseModel):
+    data: List[OrderCompleteSchemaRequest]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'data': [
+                        {'courier_id': 2, 'order_id': 33, 'complete_time': '2021-01-10T10:33:01.422'},
+                        {'courier_id': 2, 'order_id': 34, 'complete_time': '2021-01-10T10:45:12.000'}
+                    ]
+                }
+        }
+
+
+class OrdersCompleteBatchSchemaResponse200(BaseModel):
+    orders: List[dict]
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'orders': [{'id': 33}, {'id': 34}]
+                }
+        }
+
+
+class OrdersCompleteBatchSchemaResponse400(BaseModel):
+    validation_error: dict
+
+    class Config:
+        schema_extra = {
+            'example':
+                {
+                    'validation_error': {'orders': [{'id': 34}]}
+                }
+        }
+
+
+post_orders_complete_batch_route = APIRouter()
+
+
+@post_orders_complete_batch_route.post('/orders/complete/batch',
+                                       responses={400: {'model': OrdersCompleteBatchSchemaResponse400},
+                                                  200: {'model': OrdersCompleteBatchSchemaResponse200}})
+async def orders_complete_batch(request: OrdersCompleteBatchSchemaRequest,
+                                idempotency_key: Optional[str] = Header(None)):
+    return await idempotent('/orders/complete/batch', idempotency_key, request, lambda: complete_orders(request))
+
+
+async def complete_orders(request: OrdersCompleteBatchSchemaRequest):
+    # заказы и курьеры читаются и проверяются в той же транзакции, в которой записываются: одновременное выполнение
+    # или назначение для тех же курьеров не будет перезаписано (строки курьеров блокируются select_for_update
+    # там, где БД это поддерживает, sqlite блокирует всю БД на время транзакции)
+    async with in_transaction('default'):
+        ids = [item.order_id for item in request.data]
+        # два запроса на весь пакет (заказы - по одному на шард): все заказы и все их курьеры
+        orders = await fan_out(lambda db: OrderDB.filter(order_id__in=ids).using_db(db))
+        orders = {order.order_id: order for order in orders}
+        couriers = await CourierDB.select_for_update().in_bulk({item.courier_id for item in request.data}, 'courier_id')
+
+        dumps = {courier_id: courier.dump() for courier_id, courier in couriers.items()}
+        counts = Counter(ids)
+
+        errors = []
+        by_courier = dict()
+        for item in request.data:
+            order = orders.get(item.order_id)
+            if order is None or order.courier_id != item.courier_id or counts[item.order_id] != 1:
+                errors.append(item.order_id)
+            elif not order.completed:
+                if item.courier_id not in dumps or order.order_id not in dumps[item.courier_id]['assigns']:
+                    errors.append(item.order_id)
+                else:
+                    by_courier.setdefault(item.courier_id, []).append(item)
+        if errors:
+            return JSONResponse(status_code=400, content={
+                'validation_error': {'orders': [{'id': i} for i in errors]}
+            })
+
+        updated_couriers = []
+        updated_orders = []
+        for courier_id, items in by_courier.items():
+            courier = couriers[courier_id]
+            data = dumps[courier_id]
+            # время выполнения каждого заказа отсчитывается от предыдущего выполненного заказа,
+            # поэтому заказы курьера обрабатываются в порядке их выполнения
+            items.sort(key=lambda x: datetime.fromisoformat(x.complete_time))
+            assign_time = data['assign_time'].replace(tzinfo=None)
+            if data['last_completed'] is None or data['assign_time'] > data['last_completed']:
+                previous = assign_time
+            else:
+                previous = data['last_completed'].replace(tzinfo=None)
+            for item in items:
+                complete_time = datetime.fromisoformat(item.complete_time)
+                order = orders[item.order_id]
+                order.completed = True
+                order.complete_time = int((complete_time - previous).total_seconds())
+                order.completed_at = complete_time
+                updated_orders.append(order)
+                data['assigns'].remove(order.order_id)
+                data['assigned_weight'] = data['assigned_weight'] - order.weight if data['assigns'] else 0
+                data['completed'].append(order.order_id)
+                data['earnings'] += courier_types[data['courier_type']].pay
+                previous = complete_time
+            courier.assigns = ','.join(map(str, data['assigns']))
+            courier.completed = ','.join(map(str, data['completed']))
+            courier.earnings = data['earnings']
+            courier.assigned_weight = data['assigned_weight']
+            courier.last_completed = previous
+            updated_couriers.append(courier)
+
+        if updated_couriers:
+            await CourierDB.bulk_update(
+                updated_couriers, fields=['assigns', 'completed', 'earnings', 'last_completed', 'assigned_weight']
+            )
+            by_shard = dict()
+            for order in updated_orders:
+                by_shard.setdefault(shard(order.region), []).append(order)
+            # шарды заказов не входят в транзакцию основной БД, но при ошибке записи в шард она откатывается
+            await asyncio.gather(*(
+                OrderDB.filter().using_db(db).bulk_update(
+                    objects, fields=['completed', 'complete_time', 'completed_at', 'updated_at']
+                ) for db, objects in by_shard.items()
+            ))
+            mark_written(*by_courier)
+        return OrdersCompleteBatchSchemaResponse200(orders=[{'id': i} for i in ids])